@@ -1,19 +1,49 @@
 from CTFd.plugins import register_plugin_assets_directory
 from CTFd.plugins.challenges import CHALLENGE_CLASSES
+from CTFd.models import db
 from .models import StorylineChallenge, SolutionDescription
 from .routes import storyline_blueprint
-from .challenge_type import StorylineChallengeType
+from .challenge_type import StorylineChallengeType, register_solve_listeners
 from .utils import init_db
+from .graph import register_graph_listeners
+from .scheduler import expiry_scheduler
+from .writebehind import description_queue
+from .instrumentation import instrumentation
+from .cli import storyline_cli
+from .events import register_commit_hooks
+from .caching import storyline_cache
+from .engine import get_engine
 
 def load(app):
+    storyline_cache.init_app(app)
     init_db()
+    register_graph_listeners()
+    register_commit_hooks()
+    register_solve_listeners()
+    expiry_scheduler.init_app(app)
+    description_queue.init_app(app)
+    instrumentation.init_app(app, storyline_blueprint.name)
 
     CHALLENGE_CLASSES["storyline"] = StorylineChallengeType
 
     app.register_blueprint(storyline_blueprint)
+    app.cli.add_command(storyline_cli)
 
     register_plugin_assets_directory(
         app, base_path="/plugins/storyline_challenges/assets/"
     )
 
+    if app.config.get('STORYLINE_PREWARM'):
+        prewarm()
+
     app.logger.info("Storyline Challenges plugin loaded successfully")
+
+def prewarm():
+    """Build the graph snapshot before workers fork (e.g. gunicorn --preload)
+
+    Forked workers inherit the snapshot and its compiled engine, so their first
+    player graph request is served warm. The engine's pool is disposed so no
+    connection opened here is shared across processes.
+    """
+    get_engine()
+    db.engine.dispose()
@@ -1,11 +1,51 @@
-// Frontend stub for challenge creation
+// Predecessor picker for challenge creation, searched server-side
 document.addEventListener('DOMContentLoaded', function() {
-    // Load available challenges for predecessor dropdown
-    fetch('/storyline/admin/challenges')
-        .then(response => response.json())
-        .then(challenges => {
-            // Populate dropdown - implementation stub
-            console.log('Challenges loaded for dropdown:', challenges);
-        });
-});
+    const select = document.getElementById('predecessor_id');
+    if (!select) {
+        return;
+    }
+
+    // CTFd serializes one value per field name, so the selection travels
+    // as a JSON array in a hidden field instead of as repeated values
+    const field = document.getElementById('predecessor_ids');
+    function syncField() {
+        field.value = JSON.stringify(Array.from(select.selectedOptions, option => Number(option.value)));
+    }
+    select.addEventListener('change', syncField);
+
+    const search = document.createElement('input');
+    search.type = 'search';
+    search.className = 'form-control mb-2';
+    search.placeholder = 'Search challenges by name';
+    select.parentNode.insertBefore(search, select);
 
+    function loadOptions(q) {
+        const params = new URLSearchParams({ q: q, limit: 50 });
+        fetch('/storyline/admin/challenges?' + params.toString())
+            .then(response => response.json())
+            .then(result => {
+                // Keep chosen predecessors selected while the list is filtered
+                const selected = Array.from(select.selectedOptions);
+                const chosen = new Set(selected.map(option => option.value));
+                select.innerHTML = '';
+                selected.forEach(option => select.appendChild(option));
+                result.data.forEach(challenge => {
+                    if (chosen.has(String(challenge.id))) {
+                        return;
+                    }
+                    const option = document.createElement('option');
+                    option.value = challenge.id;
+                    option.textContent = challenge.name + ' (' + challenge.category + ')';
+                    select.appendChild(option);
+                });
+            });
+    }
+
+    let timer = null;
+    search.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(() => loadOptions(search.value), 200);
+    });
+
+    loadOptions('');
+});
@@ -1,11 +1,93 @@
-     // Frontend stub for challenge update
+// Predecessor picker for challenge update, searched server-side
 document.addEventListener('DOMContentLoaded', function() {
-    // Load available challenges for predecessor dropdown
-    fetch('/storyline/admin/challenges')
-        .then(response => response.json())
-        .then(challenges => {
-            // Populate dropdown and set current values - implementation stub
-            console.log('Challenges loaded for update form:', challenges);
-        });
-});
+    const select = document.getElementById('predecessor_id');
+    const challengeId = window.CHALLENGE_ID;
+    if (!select) {
+        return;
+    }
+
+    // CTFd serializes one value per field name, so the selection travels
+    // as a JSON array in a hidden field instead of as repeated values
+    const field = document.getElementById('predecessor_ids');
+    function syncField() {
+        field.value = JSON.stringify(Array.from(select.selectedOptions, option => Number(option.value)));
+    }
+    select.addEventListener('change', syncField);
+
+    const search = document.createElement('input');
+    search.type = 'search';
+    search.className = 'form-control mb-2';
+    search.placeholder = 'Search challenges by name';
+    select.parentNode.insertBefore(search, select);
+
+    function addOption(challenge, selected) {
+        const option = document.createElement('option');
+        option.value = challenge.id;
+        option.textContent = challenge.name + ' (' + challenge.category + ')';
+        option.selected = selected;
+        select.appendChild(option);
+    }
+
+    function loadOptions(q) {
+        // exclude_for drops this challenge and everything downstream of it,
+        // which would otherwise close a cycle
+        const params = new URLSearchParams({ q: q, limit: 50 });
+        if (challengeId) {
+            params.set('exclude_for', challengeId);
+        }
+        return fetch('/storyline/admin/challenges?' + params.toString())
+            .then(response => response.json())
+            .then(result => {
+                const selected = Array.from(select.selectedOptions);
+                const chosen = new Set(selected.map(option => option.value));
+                select.innerHTML = '';
+                selected.forEach(option => select.appendChild(option));
+                result.data.forEach(challenge => {
+                    if (!chosen.has(String(challenge.id))) {
+                        addOption(challenge, false);
+                    }
+                });
+            });
+    }
 
+    function loadCurrent() {
+        if (!challengeId) {
+            return Promise.resolve();
+        }
+        return fetch('/api/v1/challenges/' + challengeId)
+            .then(response => response.json())
+            .then(result => {
+                const data = result.data || {};
+                if (data.unlock_mode) {
+                    document.getElementById('unlock_mode').value = data.unlock_mode;
+                }
+                if (data.max_lifetime) {
+                    document.getElementById('max_lifetime').value = data.max_lifetime;
+                }
+
+                const predecessorIds = data.predecessor_ids || [];
+                if (!predecessorIds.length) {
+                    return;
+                }
+                const params = new URLSearchParams();
+                predecessorIds.forEach(id => params.append('id', id));
+                return fetch('/storyline/admin/challenges?' + params.toString())
+                    .then(response => response.json())
+                    .then(current => current.data.forEach(challenge => addOption(challenge, true)));
+            });
+    }
+
+    let timer = null;
+    search.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(() => loadOptions(search.value), 200);
+    });
+
+    loadCurrent().then(() => {
+        // Only submit predecessors once the current ones are known, so an
+        // early save cannot clear them
+        syncField();
+        field.disabled = false;
+        return loadOptions('');
+    });
+});
@@ -1,12 +1,63 @@
 // Frontend stub for challenge view and graph visualization
 document.addEventListener('DOMContentLoaded', function() {
-    // Load player's graph data
-    fetch('/storyline/player/graph')
-        .then(response => response.json())
-        .then(data => {
-            // Render graph visualization - implementation stub
-            console.log('Player graph data:', data);
+    // Player graph state, kept current by the server-sent event stream
+    const graph = { nodes: {}, clockOffset: 0 };
+
+    function setServerClock(now) {
+        graph.clockOffset = Date.parse(now + 'Z') - Date.now();
+    }
+
+    function timeRemaining(node) {
+        if (!node.expires_at) {
+            return null;
+        }
+        const remaining = Date.parse(node.expires_at + 'Z') - (Date.now() + graph.clockOffset);
+        return Math.max(0, Math.floor(remaining / 60000));
+    }
+
+    function renderGraph() {
+        // Render graph visualization - implementation stub
+        Object.values(graph.nodes).forEach(node => {
+            node.time_remaining = timeRemaining(node);
+        });
+        console.log('Player graph data:', Object.values(graph.nodes));
+    }
+
+    function loadGraph(data) {
+        graph.nodes = {};
+        data.nodes.forEach(node => {
+            graph.nodes[node.id] = node;
         });
+        if (data.now) {
+            setServerClock(data.now);
+        }
+        renderGraph();
+    }
+
+    if (window.EventSource) {
+        const stream = new EventSource('/storyline/player/stream');
+
+        stream.addEventListener('snapshot', event => loadGraph(JSON.parse(event.data)));
+        ['unlocked', 'solved', 'expired', 'locked'].forEach(status => {
+            stream.addEventListener(status, event => {
+                const node = JSON.parse(event.data);
+                if (status === 'locked' || (status === 'expired' && !node.name)) {
+                    delete graph.nodes[node.id];
+                } else {
+                    graph.nodes[node.id] = node;
+                }
+                renderGraph();
+            });
+        });
+        stream.addEventListener('tick', event => setServerClock(JSON.parse(event.data).now));
+
+        // Countdowns are computed locally from the absolute expires_at
+        setInterval(renderGraph, 60000);
+    } else {
+        fetch('/storyline/player/graph')
+            .then(response => response.json())
+            .then(loadGraph);
+    }
 
     // Handle solution description modal after solving
     document.addEventListener('challenge-solved', function(event) {
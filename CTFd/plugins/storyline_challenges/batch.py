@@ -0,0 +1,290 @@
+from datetime import datetime, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EPOCH = datetime(1970, 1, 1)
+KINDS = ('solved', 'unlocked', 'expired')
+
+def _seconds(moment):
+    return (moment - EPOCH).total_seconds()
+
+class CompiledGraph:
+    """Evaluation plan of one graph snapshot over dense challenge indices
+
+    Incoming edges are grouped by challenge (pred_ptr/pred_index/pred_window)
+    for evaluating one team in topological order; with NumPy, outgoing edges
+    are also grouped by predecessor (CSR) for evaluating many teams at once.
+    """
+
+    def __init__(self, graph):
+        self.ids = graph.ids
+        self.index = graph.index
+        self.size = len(graph.ids)
+        self.width = (self.size + 7) // 8
+        self.any_rule = [graph.unlock_mode[cid] == 'any' for cid in self.ids]
+
+        # Predecessors missing from the snapshot keep index -1 and are never satisfied
+        self.pred_ptr = [0]
+        self.pred_index = []
+        self.pred_window = []
+        for challenge_id in self.ids:
+            for predecessor_id, lifetime in graph.prerequisites(challenge_id):
+                self.pred_index.append(self.index.get(predecessor_id, -1))
+                self.pred_window.append(timedelta(minutes=lifetime) if lifetime else None)
+            self.pred_ptr.append(len(self.pred_index))
+        self.order = [self.index[cid] for cid in graph.order if graph.predecessors[cid]]
+
+        edges = sorted(
+            (self.index[predecessor_id], self.index[challenge_id], lifetime)
+            for (predecessor_id, challenge_id), lifetime in graph.edge_lifetime.items()
+            if predecessor_id in self.index and challenge_id in self.index
+        )
+        in_degree = [len(graph.predecessors[cid]) for cid in self.ids]
+        out_degree = [0] * self.size
+        for parent, _, _ in edges:
+            out_degree[parent] += 1
+
+        self.root_bits = 0
+        for challenge_id in graph.roots:
+            self.root_bits |= 1 << self.index[challenge_id]
+
+        if np is None:
+            return
+
+        self.edge_child = np.array([child for _, child, _ in edges], dtype=np.int64)
+        self.edge_lifetime = np.array(
+            [lifetime * 60.0 if lifetime else np.inf for _, _, lifetime in edges], dtype=np.float64
+        )
+        self.out_degree = np.array(out_degree, dtype=np.int64)
+        self.parent_ptr = np.concatenate(([0], np.cumsum(self.out_degree)))
+        self.in_degree = np.array(in_degree, dtype=np.int64)
+        self.any_mode = np.array(self.any_rule, dtype=bool)
+        self.root_row = np.frombuffer(self.root_bits.to_bytes(self.width, 'little'), dtype=np.uint8)
+
+    def dense(self, team_solves):
+        """Spread {challenge_id: solved_at} over dense indices, None where unsolved"""
+        solved_at = [None] * self.size
+        for challenge_id, moment in team_solves.items():
+            position = self.index.get(challenge_id)
+            if position is not None:
+                solved_at[position] = moment
+        return solved_at
+
+    def rule(self, position, solved_at):
+        """Evaluate one challenge's prerequisites against dense solve times
+
+        Returns (unlocked_at, expires_at), or None while the rule is unmet. With
+        'all' the challenge opens on the last prerequisite solve and closes with
+        the earliest window; with 'any' it opens on the first solve and stays
+        open as long as any window does.
+        """
+        start, end = self.pred_ptr[position], self.pred_ptr[position + 1]
+        windows = []
+        for edge in range(start, end):
+            predecessor = self.pred_index[edge]
+            moment = solved_at[predecessor] if predecessor >= 0 else None
+            if moment is not None:
+                window = self.pred_window[edge]
+                windows.append((moment, moment + window if window is not None else None))
+        if not windows:
+            return None
+
+        if self.any_rule[position]:
+            expiries = [expires_at for _, expires_at in windows]
+            return (
+                min(moment for moment, _ in windows),
+                None if None in expiries else max(expiries)
+            )
+
+        if len(windows) < end - start:
+            return None
+        expiries = [expires_at for _, expires_at in windows if expires_at is not None]
+        return (
+            max(moment for moment, _ in windows),
+            min(expiries) if expiries else None
+        )
+
+    def evaluate(self, team_solves):
+        """Return {challenge_id: (unlocked_at, expires_at)} for one team in a single topological pass"""
+        solved_at = self.dense(team_solves)
+        unlocks = {}
+        for position in self.order:
+            result = self.rule(position, solved_at)
+            if result is not None:
+                unlocks[self.ids[position]] = result
+        return unlocks
+
+def compile_graph(graph):
+    """Return the compiled arrays of a snapshot, built once per graph version"""
+    if graph._compiled is None:
+        graph._compiled = CompiledGraph(graph)
+    return graph._compiled
+
+class BatchResult:
+    """Solved, unlocked and expired bitsets of many teams, one row per team
+
+    With NumPy each kind is a (teams, ceil(challenges / 8)) uint8 matrix;
+    without it each row is a Python int. Either way a team costs three bits
+    per challenge in the storyline. Expired means the window lapsed without a
+    solve, as in /admin/expiring and the expiry statistics.
+    """
+
+    def __init__(self, compiled, team_ids, rows):
+        self.compiled = compiled
+        self.team_ids = team_ids
+        self.position = {team_id: i for i, team_id in enumerate(team_ids)}
+        self.rows = rows
+
+    def counts(self, kind):
+        """Return {team_id: number of challenges in that state}"""
+        rows = self.rows[kind]
+        if np is not None:
+            totals = POPCOUNT[rows].sum(axis=1, dtype=np.int64) if len(self.team_ids) else []
+            return dict(zip(self.team_ids, (int(total) for total in totals)))
+        return {team_id: bin(bits).count('1') for team_id, bits in zip(self.team_ids, rows)}
+
+    def challenge_ids(self, kind, team_id):
+        """Return the challenge ids of one team in that state"""
+        position = self.position.get(team_id)
+        if position is None:
+            bits = self.compiled.root_bits if kind == 'unlocked' else 0
+        elif np is not None:
+            bits = int.from_bytes(self.rows[kind][position].tobytes(), 'little')
+        else:
+            bits = self.rows[kind][position]
+
+        ids = set()
+        while bits:
+            low = bits & -bits
+            ids.add(self.compiled.ids[low.bit_length() - 1])
+            bits ^= low
+        return ids
+
+def evaluate_many(graph, team_ids, solves, now=None):
+    """Evaluate the unlock rules for many teams at once
+
+    solves yields (team_id, challenge_id, solved_at). A challenge's rule only
+    depends on the solves of its direct predecessors, so every (team, child)
+    pair is settled from the edges leaving solved challenges without walking
+    the graph. Matches CompiledGraph.rule for each team.
+    """
+    now = now or datetime.utcnow()
+    compiled = compile_graph(graph)
+    team_ids = list(team_ids)
+    if np is not None:
+        rows = _evaluate_numpy(compiled, team_ids, solves, _seconds(now))
+    else:
+        rows = _evaluate_python(graph, compiled, team_ids, solves, now)
+    return BatchResult(compiled, team_ids, rows)
+
+def _evaluate_python(graph, compiled, team_ids, solves, now):
+    team_solves = {team_id: {} for team_id in team_ids}
+    for team_id, challenge_id, solved_at in solves:
+        if team_id in team_solves and challenge_id in compiled.index:
+            team_solves[team_id][challenge_id] = solved_at
+
+    rows = {kind: [] for kind in KINDS}
+    for team_id in team_ids:
+        solved = team_solves[team_id]
+        solved_bits = unlocked_bits = expired_bits = 0
+        for challenge_id in solved:
+            solved_bits |= 1 << compiled.index[challenge_id]
+
+        solved_at = compiled.dense(solved)
+        candidates = {child for challenge_id in solved for child in graph.children.get(challenge_id, [])}
+        for challenge_id in candidates:
+            position = compiled.index[challenge_id]
+            result = compiled.rule(position, solved_at)
+            if result is None:
+                continue
+            expires_at = result[1]
+            if expires_at is not None and now > expires_at:
+                if challenge_id not in solved:
+                    expired_bits |= 1 << position
+            else:
+                unlocked_bits |= 1 << position
+
+        rows['solved'].append(solved_bits)
+        rows['unlocked'].append((unlocked_bits | compiled.root_bits) & ~expired_bits)
+        rows['expired'].append(expired_bits)
+    return rows
+
+def _set_bits(matrix, team, node):
+    np.bitwise_or.at(matrix, (team, node >> 3), np.left_shift(1, node & 7).astype(np.uint8))
+
+def _lookup(sorted_keys, values):
+    """Map values to their positions in sorted_keys, -1 where absent"""
+    if not len(sorted_keys):
+        return np.full(len(values), -1, dtype=np.int64)
+    positions = np.searchsorted(sorted_keys, values)
+    positions = np.minimum(positions, len(sorted_keys) - 1)
+    return np.where(sorted_keys[positions] == values, positions, -1)
+
+def _solve_arrays(compiled, team_ids, solves):
+    """Convert (team_id, challenge_id, solved_at) rows to dense team, node and epoch-second arrays"""
+    solves = list(solves)
+    if not solves:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0, dtype=np.float64)
+
+    teams, challenges, dates = zip(*solves)
+    team_order = np.argsort(np.array(team_ids, dtype=np.int64), kind='stable')
+    team = _lookup(np.array(team_ids, dtype=np.int64)[team_order], np.array(teams, dtype=np.int64))
+    team = np.where(team >= 0, team_order[np.maximum(team, 0)], -1)
+    node = _lookup(np.array(compiled.ids, dtype=np.int64), np.array(challenges, dtype=np.int64))
+    seconds = np.fromiter(((date - EPOCH).total_seconds() for date in dates), dtype=np.float64, count=len(dates))
+
+    known = (team >= 0) & (node >= 0)
+    return team[known], node[known], seconds[known]
+
+def _evaluate_numpy(compiled, team_ids, solves, now):
+    shape = (len(team_ids), compiled.width)
+    solve_team, solve_node, solve_time = _solve_arrays(compiled, team_ids, solves)
+
+    # Keep the last solve of a (team, challenge) pair, as the per-team dicts do
+    _, last = np.unique((solve_team * compiled.size + solve_node)[::-1], return_index=True)
+    keep = len(solve_node) - 1 - last
+    solve_team, solve_node, solve_time = solve_team[keep], solve_node[keep], solve_time[keep]
+
+    solved = np.zeros(shape, dtype=np.uint8)
+    unlocked = np.zeros(shape, dtype=np.uint8)
+    expired = np.zeros(shape, dtype=np.uint8)
+    _set_bits(solved, solve_team, solve_node)
+
+    # Fan each solve out over the edges leaving the solved challenge
+    fanout = compiled.out_degree[solve_node]
+    source = np.repeat(np.arange(len(solve_node)), fanout)
+    offset = np.arange(len(source)) - np.repeat(np.cumsum(fanout) - fanout, fanout)
+    edge = compiled.parent_ptr[solve_node][source] + offset
+
+    if len(edge):
+        child = compiled.edge_child[edge]
+        key = solve_team[source] * compiled.size + child
+        started = solve_time[source]
+        closes = started + compiled.edge_lifetime[edge]
+
+        order = np.argsort(key, kind='stable')
+        key, started, closes = key[order], started[order], closes[order]
+        starts = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+        satisfied = np.diff(np.append(starts, len(key)))
+
+        key = key[starts]
+        team, node = key // compiled.size, key % compiled.size
+        any_mode = compiled.any_mode[node]
+
+        # 'all' closes with its earliest window, 'any' with its latest; inf is open-ended
+        expires = np.where(any_mode, np.maximum.reduceat(closes, starts), np.minimum.reduceat(closes, starts))
+        met = any_mode | (satisfied == compiled.in_degree[node])
+        lapsed = met & (expires < now)
+        _set_bits(unlocked, team[met & ~lapsed], node[met & ~lapsed])
+        _set_bits(expired, team[lapsed], node[lapsed])
+
+    expired &= ~solved
+    unlocked |= compiled.root_row
+    unlocked &= ~expired
+    return {'solved': solved, 'unlocked': unlocked, 'expired': expired}
+
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8) if np is not None else None
@@ -0,0 +1,277 @@
+from CTFd.models import db, Challenges, Flags
+from .models import StorylineChallenge, StorylinePrerequisite, UNLOCK_MODES
+from .graph import get_graph, invalidate_graph, topological_sort
+from .manager import StorylineManager
+import json
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+FORMATS = ('json', 'yaml')
+PARSE_ERRORS = (ValueError, yaml.YAMLError) if yaml is not None else (ValueError,)
+
+class StorylineImportError(Exception):
+    """Raised with every problem found in a storyline document; nothing is written"""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors))
+        self.errors = errors
+
+def parse_document(text, fmt='json'):
+    """Parse a JSON or YAML storyline document"""
+    if fmt not in FORMATS:
+        raise StorylineImportError([f"Unsupported format {fmt!r}, use one of {', '.join(FORMATS)}"])
+    if fmt == 'yaml' and yaml is None:
+        raise StorylineImportError(["YAML storylines need PyYAML installed"])
+
+    try:
+        return yaml.safe_load(text) if fmt == 'yaml' else json.loads(text)
+    except PARSE_ERRORS as e:
+        raise StorylineImportError([f"Could not parse document: {e}"])
+
+def _positive_int(value):
+    if value in (None, ''):
+        return None
+    value = int(value)
+    if value <= 0:
+        raise ValueError(value)
+    return value
+
+def validate_document(document):
+    """Normalize a storyline document and check the whole DAG in memory
+
+    Each challenge has a document-local 'key'; predecessors name other keys,
+    or {'challenge_id': N} for a challenge that already exists. Returns the
+    normalized challenges in topological order.
+    """
+    if not isinstance(document, dict) or not isinstance(document.get('challenges'), list):
+        raise StorylineImportError(["Document must be an object with a 'challenges' list"])
+
+    graph = get_graph()
+    errors = []
+    challenges = {}
+
+    for index, entry in enumerate(document['challenges']):
+        where = f"challenges[{index}]"
+        if not isinstance(entry, dict):
+            errors.append(f"{where} must be an object")
+            continue
+
+        key = str(entry.get('key', entry.get('name', '')))
+        if not key or not entry.get('name'):
+            errors.append(f"{where} needs a name")
+            continue
+        if key in challenges:
+            errors.append(f"{where} reuses key {key!r}")
+            continue
+
+        challenge = {
+            'key': key,
+            'name': entry['name'],
+            'description': entry.get('description', ''),
+            'category': entry.get('category', ''),
+            'state': entry.get('state', 'visible'),
+            'unlock_mode': entry.get('unlock_mode', 'all'),
+            'flags': [],
+            'predecessors': [],
+            'existing': []
+        }
+
+        try:
+            challenge['value'] = int(entry.get('value', 0))
+        except (TypeError, ValueError):
+            errors.append(f"{where} has a non-integer value")
+        try:
+            challenge['max_lifetime'] = _positive_int(entry.get('max_lifetime'))
+        except (TypeError, ValueError):
+            errors.append(f"{where} max_lifetime must be a positive number of minutes")
+            challenge['max_lifetime'] = None
+
+        if challenge['unlock_mode'] not in UNLOCK_MODES:
+            errors.append(f"{where} unlock_mode must be one of {', '.join(UNLOCK_MODES)}")
+        if challenge['state'] not in ('visible', 'hidden'):
+            errors.append(f"{where} state must be visible or hidden")
+
+        for field in ('flags', 'predecessors'):
+            if not isinstance(entry.get(field, []), list):
+                errors.append(f"{where} {field} must be a list")
+                entry = dict(entry, **{field: []})
+
+        for flag in entry.get('flags', []):
+            if isinstance(flag, str):
+                flag = {'content': flag}
+            if not isinstance(flag, dict) or not flag.get('content'):
+                errors.append(f"{where} has a flag without content")
+                continue
+            challenge['flags'].append({
+                'type': flag.get('type', 'static'),
+                'content': flag['content'],
+                'data': flag.get('data', '')
+            })
+
+        for predecessor in entry.get('predecessors', []):
+            if not isinstance(predecessor, dict):
+                predecessor = {'key': predecessor}
+            try:
+                lifetime = _positive_int(predecessor.get('max_lifetime', challenge['max_lifetime']))
+            except (TypeError, ValueError):
+                errors.append(f"{where} has a predecessor with an invalid max_lifetime")
+                continue
+
+            if predecessor.get('challenge_id') is not None:
+                try:
+                    challenge['existing'].append((int(predecessor['challenge_id']), lifetime))
+                except (TypeError, ValueError):
+                    errors.append(f"{where} has a non-integer predecessor challenge_id")
+            else:
+                challenge['predecessors'].append((str(predecessor.get('key')), lifetime))
+
+        # A predecessor listed twice keeps its first lifetime, as in the admin forms
+        for field in ('predecessors', 'existing'):
+            seen = set()
+            challenge[field] = [p for p in challenge[field] if not (p[0] in seen or seen.add(p[0]))]
+
+        challenges[key] = challenge
+
+    for challenge in challenges.values():
+        for predecessor_key, _ in challenge['predecessors']:
+            if predecessor_key not in challenges:
+                errors.append(f"Challenge {challenge['key']!r} has unknown predecessor {predecessor_key!r}")
+            elif predecessor_key == challenge['key']:
+                errors.append(f"Challenge {challenge['key']!r} lists itself as a predecessor")
+        for challenge_id, _ in challenge['existing']:
+            if challenge_id not in graph.nodes:
+                errors.append(f"Challenge {challenge['key']!r} references non-existent challenge {challenge_id}")
+
+    order, cyclic = topological_sort({
+        key: [p for p, _ in challenge['predecessors'] if p in challenges]
+        for key, challenge in challenges.items()
+    })
+    if cyclic:
+        errors.append(f"Storyline contains a cycle through {sorted(cyclic)}")
+
+    if errors:
+        raise StorylineImportError(errors)
+
+    return [challenges[key] for key in order]
+
+def import_storyline(document, dry_run=False):
+    """Validate a storyline document and insert it in a single transaction
+
+    Returns {key: challenge_id} for the created challenges. Challenges that
+    only depend on other new challenges cannot be unlocked yet; those with
+    {'challenge_id': N} predecessors may already be unlocked by existing
+    solves, so their unlocks and statistics are computed before committing.
+    """
+    challenges = validate_document(document)
+    if dry_run:
+        return {challenge['key']: None for challenge in challenges}
+
+    try:
+        rows = [{
+            'name': c['name'],
+            'description': c['description'],
+            'category': c['category'],
+            'value': c['value'],
+            'state': c['state'],
+            'type': 'storyline'
+        } for c in challenges]
+        db.session.bulk_insert_mappings(Challenges, rows, return_defaults=True)
+        ids = {c['key']: row['id'] for c, row in zip(challenges, rows)}
+
+        prerequisites = []
+        for c in challenges:
+            prerequisites.extend((ids[c['key']], ids[key], lifetime) for key, lifetime in c['predecessors'])
+            prerequisites.extend((ids[c['key']], challenge_id, lifetime) for challenge_id, lifetime in c['existing'])
+
+        first = {}
+        for challenge_id, predecessor_id, _ in prerequisites:
+            first.setdefault(challenge_id, predecessor_id)
+
+        db.session.bulk_insert_mappings(Flags, [
+            dict(flag, challenge_id=ids[c['key']]) for c in challenges for flag in c['flags']
+        ])
+        db.session.bulk_insert_mappings(StorylineChallenge, [{
+            'id': ids[c['key']],
+            'predecessor_id': first.get(ids[c['key']]),
+            'max_lifetime': c['max_lifetime'],
+            'unlock_mode': c['unlock_mode']
+        } for c in challenges])
+        db.session.bulk_insert_mappings(StorylinePrerequisite, [{
+            'challenge_id': challenge_id,
+            'predecessor_id': predecessor_id,
+            'max_lifetime': lifetime
+        } for challenge_id, predecessor_id, lifetime in prerequisites])
+
+        db.session.flush()
+        for c in challenges:
+            if c['existing']:
+                StorylineManager.resync_unlocks(ids[c['key']])
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    invalidate_graph()
+    return ids
+
+def export_storyline(fmt='json'):
+    """Stream every storyline challenge as a document import_storyline accepts"""
+    if fmt not in FORMATS:
+        raise StorylineImportError([f"Unsupported format {fmt!r}, use one of {', '.join(FORMATS)}"])
+    if fmt == 'yaml' and yaml is None:
+        raise StorylineImportError(["YAML storylines need PyYAML installed"])
+
+    graph = get_graph()
+    flags = {}
+    for flag in db.session.query(
+        Flags.challenge_id, Flags.type, Flags.content, Flags.data
+    ).join(Challenges, Challenges.id == Flags.challenge_id).filter(Challenges.type == 'storyline').yield_per(1000):
+        flags.setdefault(flag.challenge_id, []).append({
+            'type': flag.type,
+            'content': flag.content,
+            'data': flag.data or ''
+        })
+
+    challenges = db.session.query(
+        Challenges.id,
+        Challenges.name,
+        Challenges.description,
+        Challenges.category,
+        Challenges.value,
+        Challenges.state
+    ).filter(Challenges.type == 'storyline').order_by(Challenges.id)
+    exported = {c.id for c in db.session.query(Challenges.id).filter(Challenges.type == 'storyline')}
+
+    yield '{"challenges": [\n' if fmt == 'json' else 'challenges:\n'
+
+    first = True
+    for c in challenges.yield_per(500):
+        entry = {
+            'key': str(c.id),
+            'name': c.name,
+            'description': c.description,
+            'category': c.category,
+            'value': c.value,
+            'state': c.state,
+            'unlock_mode': graph.unlock_mode.get(c.id, 'all'),
+            'max_lifetime': graph.max_lifetime.get(c.id),
+            'flags': flags.get(c.id, []),
+            'predecessors': [
+                {'key': str(p), 'max_lifetime': lifetime} if p in exported
+                else {'challenge_id': p, 'max_lifetime': lifetime}
+                for p, lifetime in graph.prerequisites(c.id)
+            ]
+        }
+
+        if fmt == 'json':
+            yield ('' if first else ',\n') + json.dumps(entry)
+        else:
+            yield yaml.safe_dump([entry], sort_keys=False)
+        first = False
+
+    if fmt == 'json':
+        yield '\n]}\n'
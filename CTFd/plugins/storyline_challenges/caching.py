@@ -0,0 +1,178 @@
+from collections import OrderedDict
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+class CacheStats:
+    """Hit/miss counters of one cache tier"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None
+        }
+
+class LocalCache:
+    """Per-worker LRU with a TTL, bounded to max_entries"""
+
+    def __init__(self, max_entries=10000, ttl=600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (entry[1] is not None and entry[1] < time.monotonic()):
+                if entry is not None:
+                    del self._entries[key]
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return entry[0]
+
+    def peek(self, key):
+        """Return a live entry without touching its recency or the counters"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            self.stats.sets += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class RedisCache:
+    """Byte values shared by every worker through any client speaking the Redis get/set/delete API"""
+
+    def __init__(self, client, prefix='storyline:', ttl=600):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.stats.misses += 1
+        else:
+            self.stats.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl or None)
+        self.stats.sets += 1
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+class StorylineCache:
+    """The plugin's cache tiers: decoded objects per worker, compact encodings shared
+
+    The shared tier is used when STORYLINE_CACHE_REDIS_URL is set, or when
+    CTFd itself caches in Redis. Failures of the shared tier only cost a
+    database round-trip, so they are logged and treated as misses.
+    """
+
+    def __init__(self):
+        self.local = LocalCache()
+        self.shared = None
+        self._app = None
+
+    def init_app(self, app, client=None):
+        self._app = app
+        self.local = LocalCache(
+            max_entries=app.config.get('STORYLINE_CACHE_MAX_TEAMS', 10000),
+            ttl=app.config.get('STORYLINE_CACHE_TTL', 600)
+        )
+
+        if client is None:
+            url = app.config.get('STORYLINE_CACHE_REDIS_URL')
+            if url is None and app.config.get('CACHE_TYPE') == 'redis':
+                url = app.config.get('CACHE_REDIS_URL')
+            if url and redis is not None:
+                client = redis.Redis.from_url(url)
+            elif url:
+                app.logger.warning("STORYLINE_CACHE_REDIS_URL is set but the redis package is not installed")
+
+        self.shared = RedisCache(client, ttl=app.config.get('STORYLINE_CACHE_TTL', 600)) if client is not None else None
+
+    def get_shared(self, key):
+        if self.shared is None:
+            return None
+        try:
+            return self.shared.get(key)
+        except Exception:
+            self._log_failure()
+            return None
+
+    def set_shared(self, key, value):
+        if self.shared is None:
+            return
+        try:
+            self.shared.set(key, value)
+        except Exception:
+            self._log_failure()
+
+    def _log_failure(self):
+        if self._app is not None:
+            self._app.logger.exception("Storyline shared cache unavailable")
+
+    def stats(self):
+        return {
+            'local': dict(self.local.stats.to_dict(), entries=len(self.local), max_entries=self.local.max_entries),
+            'shared': self.shared.stats.to_dict() if self.shared is not None else None
+        }
+
+storyline_cache = StorylineCache()
+
+def pack_ids(ids, index, size):
+    """Encode a set of challenge ids as a little-endian bitset over dense indices"""
+    bits = 0
+    for challenge_id in ids:
+        position = index.get(challenge_id)
+        if position is not None:
+            bits |= 1 << position
+    return bits.to_bytes((size + 7) // 8, 'little')
+
+def unpack_ids(data, ids):
+    """Decode a bitset from pack_ids back into challenge ids"""
+    bits = int.from_bytes(data, 'little')
+    unpacked = set()
+    while bits:
+        low = bits & -bits
+        unpacked.add(ids[low.bit_length() - 1])
+        bits ^= low
+    return unpacked
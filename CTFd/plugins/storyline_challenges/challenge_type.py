@@ -1,9 +1,27 @@
 from CTFd.plugins.challenges import BaseChallenge
 from CTFd.models import db, Challenges, Solves
-from CTFd.utils.user import get_current_team, get_current_user
-from .models import StorylineChallenge, SolutionDescription
-from flask import request, jsonify
+from CTFd.utils.user import get_current_team, get_current_team_attrs, get_current_user, get_ip, is_admin
+from .models import (
+    StorylineChallenge, StorylineChallengeModel, StorylinePrerequisite, SolutionDescription, StorylineUnlock,
+    StorylineNodeStats, StorylineSolveTimeBucket, StorylineExpiry, UNLOCK_MODES
+)
+from .manager import StorylineManager
+from .bulk import _positive_int
+from .graph import get_graph, invalidate_graph
+from .engine import get_engine
+from .state import bump_team_version
+from .scheduler import expiry_scheduler
+from .writebehind import description_queue
+from . import events
+from .instrumentation import instrumented
+from .stats import rebuild_stats, record_solve, record_unlocks
+from flask import abort, request, jsonify
 from datetime import datetime, timedelta
+from sqlalchemy import event, or_
+import json
+
+PREDECESSOR_FIELDS = ('predecessor_id', 'predecessor_ids', 'prerequisites')
+STORYLINE_FIELDS = PREDECESSOR_FIELDS + ('max_lifetime', 'unlock_mode')
 
 class StorylineChallengeType(BaseChallenge):
     id = "storyline"
@@ -18,81 +36,197 @@ class StorylineChallengeType(BaseChallenge):
         "update": "/plugins/storyline_challenges/assets/update.js",
         "view": "/plugins/storyline_challenges/assets/view.js",
     }
+    challenge_model = StorylineChallengeModel
 
     @staticmethod
+    @instrumented('challenge.create')
     def create(request):
         data = request.form or request.get_json()
-        challenge = Challenges(**data)
+        _, _, prerequisites = StorylineChallengeType.parse_storyline_data(data)
+        StorylineChallengeType.check_prerequisites(None, [p for p, _ in prerequisites or []])
+
+        challenge = StorylineChallengeModel(**{k: v for k, v in data.items() if k not in STORYLINE_FIELDS})
         db.session.add(challenge)
+        db.session.flush()
+
+        StorylineChallengeType.save_storyline_data(challenge.id, data)
+        StorylineManager.resync_unlocks(challenge.id)
         db.session.commit()
+        invalidate_graph()
+
+        return challenge
+
+    @staticmethod
+    def parse_storyline_data(data, unlock_mode='all', max_lifetime=None):
+        """Extract (unlock_mode, max_lifetime, [(predecessor_id, max_lifetime)]) from form or JSON data
 
-        predecessor_id = data.get('predecessor_id')
-        max_lifetime = data.get('max_lifetime')
+        Fields missing from the data keep the given values. The prerequisites
+        are None unless the data carries one of PREDECESSOR_FIELDS.
+        """
+        if 'max_lifetime' in data:
+            try:
+                max_lifetime = _positive_int(data.get('max_lifetime'))
+            except (TypeError, ValueError):
+                abort(400, description="max_lifetime must be a positive number of minutes")
+        if 'unlock_mode' in data:
+            unlock_mode = data.get('unlock_mode') or 'all'
+        if unlock_mode not in UNLOCK_MODES:
+            abort(400, description=f"unlock_mode must be one of {', '.join(UNLOCK_MODES)}")
 
-        if predecessor_id == '':
-            predecessor_id = None
-        if max_lifetime == '':
-            max_lifetime = None
+        if not any(field in data for field in PREDECESSOR_FIELDS):
+            return unlock_mode, max_lifetime, None
 
-        storyline_data = StorylineChallenge(
-            id=challenge.id,
-            predecessor_id=predecessor_id,
-            max_lifetime=max_lifetime
+        if data.get('prerequisites'):
+            try:
+                prerequisites = [
+                    (int(p['predecessor_id']), _positive_int(p.get('max_lifetime', max_lifetime)))
+                    for p in data['prerequisites']
+                ]
+            except (KeyError, TypeError, ValueError):
+                abort(400, description="prerequisites must be a list of {predecessor_id, max_lifetime} "
+                                       "with a positive max_lifetime in minutes")
+        else:
+            if hasattr(data, 'getlist'):
+                predecessor_ids = data.getlist('predecessor_ids') or data.getlist('predecessor_id')
+            else:
+                predecessor_ids = data.get('predecessor_ids') or data.get('predecessor_id')
+                if not isinstance(predecessor_ids, list):
+                    predecessor_ids = [predecessor_ids]
+
+            # The admin forms send the multi-select as one JSON array, since
+            # CTFd's form serializer keeps a single value per field name
+            if len(predecessor_ids) == 1 and isinstance(predecessor_ids[0], str) and predecessor_ids[0].startswith('['):
+                try:
+                    predecessor_ids = json.loads(predecessor_ids[0])
+                except ValueError:
+                    abort(400, description="predecessor_ids must be a JSON array of challenge ids")
+            try:
+                prerequisites = [(int(p), max_lifetime) for p in predecessor_ids if p not in (None, '')]
+            except (TypeError, ValueError):
+                abort(400, description="predecessor_ids must be challenge ids")
+
+        seen = set()
+        prerequisites = [p for p in prerequisites if not (p[0] in seen or seen.add(p[0]))]
+        return unlock_mode, max_lifetime, prerequisites
+
+    @staticmethod
+    def check_prerequisites(challenge_id, predecessor_ids):
+        """Abort with 400 on unknown predecessors or an edge that would close a cycle"""
+        graph = get_graph()
+        unknown = [p for p in predecessor_ids if p not in graph.nodes]
+        if unknown:
+            abort(400, description=f"Unknown predecessor challenges: {unknown}")
+        if challenge_id is not None and graph.would_create_cycle(challenge_id, predecessor_ids):
+            abort(400, description="These predecessors would create a cycle in the storyline")
+
+    @staticmethod
+    def save_storyline_data(challenge_id, data):
+        """Write the storyline fields the data carries; the edges are replaced only if it carries predecessors"""
+        storyline_data = StorylineChallenge.query.filter_by(id=challenge_id).first()
+        if not storyline_data:
+            storyline_data = StorylineChallenge(id=challenge_id)
+            db.session.add(storyline_data)
+
+        unlock_mode, max_lifetime, prerequisites = StorylineChallengeType.parse_storyline_data(
+            data, storyline_data.unlock_mode or 'all', storyline_data.max_lifetime
         )
-        db.session.add(storyline_data)
-        db.session.commit()
+        storyline_data.max_lifetime = max_lifetime
+        storyline_data.unlock_mode = unlock_mode
+        if prerequisites is None:
+            return
 
-        return challenge
+        StorylineChallengeType.check_prerequisites(challenge_id, [p for p, _ in prerequisites])
+        storyline_data.predecessor_id = prerequisites[0][0] if prerequisites else None
+        StorylinePrerequisite.query.filter_by(challenge_id=challenge_id).delete()
+        db.session.add_all([
+            StorylinePrerequisite(challenge_id=challenge_id, predecessor_id=predecessor_id, max_lifetime=lifetime)
+            for predecessor_id, lifetime in prerequisites
+        ])
+
+    @staticmethod
+    def check_access(challenge):
+        """Abort with 403 if the current team has not unlocked the challenge"""
+        if is_admin():
+            return
+
+        team = get_current_team_attrs()
+        if team is None:
+            return
+
+        accessible, reason = get_engine().accessible(team.id, challenge.id)
+        if not accessible:
+            abort(403, description=reason)
 
     @staticmethod
+    @instrumented('challenge.read')
     def read(challenge):
+        StorylineChallengeType.check_access(challenge)
+
         challenge_data = challenge.__dict__.copy()
         storyline_data = StorylineChallenge.query.filter_by(id=challenge.id).first()
-        if storyline_data:
-            challenge_data['predecessor_id'] = storyline_data.predecessor_id
-            challenge_data['max_lifetime'] = storyline_data.max_lifetime
-        else:
-            challenge_data['predecessor_id'] = None
-            challenge_data['max_lifetime'] = None
+        prerequisites = StorylinePrerequisite.query.filter_by(challenge_id=challenge.id).all()
+
+        challenge_data['predecessor_id'] = storyline_data.predecessor_id if storyline_data else None
+        challenge_data['max_lifetime'] = storyline_data.max_lifetime if storyline_data else None
+        challenge_data['unlock_mode'] = storyline_data.unlock_mode if storyline_data else 'all'
+        challenge_data['predecessor_ids'] = [p.predecessor_id for p in prerequisites]
+        challenge_data['prerequisites'] = [{
+            'predecessor_id': p.predecessor_id,
+            'max_lifetime': p.max_lifetime
+        } for p in prerequisites]
         return challenge_data
 
     @staticmethod
+    @instrumented('challenge.update')
     def update(challenge, request):
         data = request.form or request.get_json()
 
         for attr, value in data.items():
-            if attr in ('predecessor_id', 'max_lifetime'):
+            if attr in STORYLINE_FIELDS:
                 continue
             setattr(challenge, attr, value)
 
-        storyline_data = StorylineChallenge.query.filter_by(id=challenge.id).first()
-        if not storyline_data:
-            storyline_data = StorylineChallenge(id=challenge.id)
-            db.session.add(storyline_data)
-
-        predecessor_id = data.get('predecessor_id')
-        max_lifetime = data.get('max_lifetime')
-
-        if predecessor_id == '':
-            predecessor_id = None
-        if max_lifetime == '':
-            max_lifetime = None
-
-        storyline_data.predecessor_id = predecessor_id
-        storyline_data.max_lifetime = max_lifetime
-
+        if any(field in data for field in STORYLINE_FIELDS):
+            StorylineChallengeType.save_storyline_data(challenge.id, data)
+            StorylineManager.resync_unlocks(challenge.id)
         db.session.commit()
+        invalidate_graph()
+        expiry_scheduler.cancel_challenge(challenge.id)
         return challenge
 
     @staticmethod
+    @instrumented('challenge.delete')
     def delete(challenge):
+        child_ids = [
+            p.challenge_id for p in StorylinePrerequisite.query.filter_by(predecessor_id=challenge.id).all()
+        ]
+
         StorylineChallenge.query.filter_by(id=challenge.id).delete()
+        StorylinePrerequisite.query.filter(or_(
+            StorylinePrerequisite.challenge_id == challenge.id,
+            StorylinePrerequisite.predecessor_id == challenge.id
+        )).delete(synchronize_session=False)
+        StorylineUnlock.query.filter_by(challenge_id=challenge.id).delete()
+        description_queue.discard_challenge(challenge.id)
         SolutionDescription.query.filter_by(challenge_id=challenge.id).delete()
+        StorylineNodeStats.query.filter_by(challenge_id=challenge.id).delete()
+        StorylineSolveTimeBucket.query.filter_by(challenge_id=challenge.id).delete()
+        StorylineExpiry.query.filter_by(challenge_id=challenge.id).delete()
         Challenges.query.filter_by(id=challenge.id).delete()
+
+        for child_id in child_ids:
+            StorylineManager.resync_unlocks(child_id)
         db.session.commit()
+        invalidate_graph()
+        expiry_scheduler.cancel_challenge(challenge.id)
+        for child_id in child_ids:
+            expiry_scheduler.cancel_challenge(child_id)
 
     @staticmethod
+    @instrumented('challenge.attempt')
     def attempt(challenge, request):
+        StorylineChallengeType.check_access(challenge)
+
         data = request.form or request.get_json()
         submission = data["submission"].strip()
         flags = challenge.flags
@@ -103,24 +237,109 @@ class StorylineChallengeType(BaseChallenge):
         return False, "Incorrect"
 
     @staticmethod
+    @instrumented('challenge.solve')
     def solve(user, team, challenge, request):
-        from CTFd.plugins.challenges import get_chal_class
-        super(StorylineChallengeType, StorylineChallengeType).solve(user, team, challenge, request)
-
+        """Record the solve, its unlocks and any write-up in a single transaction"""
         data = request.form or request.get_json()
-        description = data.get('solution_description', '')
-
-        if description:
-            solution_desc = SolutionDescription(
-                team_id=team.id,
-                user_id=user.id,
-                challenge_id=challenge.id,
-                description=description
-            )
-            db.session.add(solution_desc)
-            db.session.commit()
+        solve = Solves(
+            user_id=user.id,
+            team_id=team.id if team else None,
+            challenge_id=challenge.id,
+            ip=get_ip(req=request),
+            provided=data["submission"].strip()
+        )
+        if team is not None:
+            db.session.info.setdefault('storyline_solves_handled', set()).add((team.id, challenge.id))
+        db.session.add(solve)
+        db.session.flush()
+
+        # Unlocks and write-ups are per team; in user mode only the solve is recorded
+        if team is not None:
+            unlocked = StorylineManager.unlock_challenges_for_team(team.id, challenge.id, solved_at=solve.date)
+            record_solve(team.id, challenge.id, solve.date, unlocked)
+
+            description = data.get('solution_description', '')
+            if description:
+                StorylineManager.save_solution_description(team.id, user.id, challenge.id, description)
+
+            events.after_commit(StorylineChallengeType.after_solve, team.id, challenge.id, unlocked)
+        db.session.commit()
+
+    @staticmethod
+    def after_solve(team_id, challenge_id, unlocked):
+        """Invalidate the team's cached state and notify listeners once a solve is committed"""
+        bump_team_version(team_id)
+        events.publish('solved', team_id=team_id, challenge_id=challenge_id)
+        for unlock in unlocked:
+            expiry_scheduler.schedule(team_id, unlock['challenge_id'], unlock['expires_at'])
+            events.publish('unlocked', team_id=team_id, **unlock)
 
     @staticmethod
+    def after_unsolve(team_id, children, unlocks):
+        """Invalidate the team's cached state and its timers once a solve removal is committed"""
+        bump_team_version(team_id)
+        for child_id in children:
+            expiry_scheduler.cancel(team_id, child_id)
+        for child_id, (_, expires_at) in unlocks.items():
+            expiry_scheduler.schedule(team_id, child_id, expires_at)
+
+    @staticmethod
+    @instrumented('challenge.fail')
     def fail(user, team, challenge, request):
         from CTFd.plugins.challenges import get_chal_class
         return super(StorylineChallengeType, StorylineChallengeType).fail(user, team, challenge, request)
+
+def _track_solves(session, flush_context):
+    """Note team solves added or removed outside StorylineChallengeType.solve"""
+    handled = session.info.get('storyline_solves_handled', ())
+    for solve in session.new:
+        if isinstance(solve, Solves) and solve.team_id is not None and (solve.team_id, solve.challenge_id) not in handled:
+            session.info.setdefault('storyline_solves_added', set()).add((solve.team_id, solve.challenge_id))
+    for solve in session.deleted:
+        if isinstance(solve, Solves) and solve.team_id is not None:
+            session.info.setdefault('storyline_solves_removed', set()).add((solve.team_id, solve.challenge_id))
+
+def _sync_tracked_solves(session):
+    """Materialize the unlocks of tracked solves in the committing transaction
+
+    Solves of standard challenges that are storyline predecessors, and solves
+    an admin adds or deletes, would otherwise never reach storyline_unlocks.
+    before_commit runs ahead of the commit's own flush, so flush first.
+    """
+    session.flush()
+    added = session.info.pop('storyline_solves_added', set())
+    removed = session.info.pop('storyline_solves_removed', set())
+    session.info.pop('storyline_solves_handled', None)
+    if not added and not removed:
+        return
+
+    graph = get_graph()
+    for team_id, challenge_id in added - removed:
+        solved_at = db.session.query(Solves.date).filter_by(team_id=team_id, challenge_id=challenge_id).scalar()
+        unlocked = StorylineManager.unlock_challenges_for_team(team_id, challenge_id)
+        if challenge_id in graph.storyline_ids:
+            record_solve(team_id, challenge_id, solved_at, unlocked)
+        else:
+            record_unlocks(unlocked)
+        events.after_commit(StorylineChallengeType.after_solve, team_id, challenge_id, unlocked)
+
+    for team_id, challenge_id in removed - added:
+        children = graph.children.get(challenge_id, [])
+        unlocks = StorylineManager.resync_team_unlocks(team_id, children)
+        for stats_id in [challenge_id, *children]:
+            if stats_id in graph.storyline_ids:
+                rebuild_stats(stats_id)
+        events.after_commit(StorylineChallengeType.after_unsolve, team_id, children, unlocks)
+
+    session.flush()
+
+def _discard_tracked_solves(session):
+    for key in ('storyline_solves_added', 'storyline_solves_removed', 'storyline_solves_handled'):
+        session.info.pop(key, None)
+
+def register_solve_listeners():
+    """Keep storyline_unlocks in step with Solves written by CTFd itself"""
+    if not event.contains(db.session, 'after_flush', _track_solves):
+        event.listen(db.session, 'after_flush', _track_solves)
+        event.listen(db.session, 'before_commit', _sync_tracked_solves)
+        event.listen(db.session, 'after_rollback', _discard_tracked_solves)
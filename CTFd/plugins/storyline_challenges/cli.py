@@ -0,0 +1,71 @@
+from flask.cli import AppGroup
+from .bulk import StorylineImportError, export_storyline, import_storyline, parse_document
+from .replay import FORMATS as TIMELINE_FORMATS, paced, replay, write_timeline
+from datetime import datetime
+import click
+import json
+import sys
+
+storyline_cli = AppGroup('storyline', help='Manage storyline challenges')
+
+@storyline_cli.command('import')
+@click.argument('source', type=click.File('r'))
+@click.option('--format', 'fmt', type=click.Choice(['json', 'yaml']), help='Defaults to the file extension')
+@click.option('--dry-run', is_flag=True, help='Validate the storyline without writing it')
+def import_command(source, fmt, dry_run):
+    """Create a storyline from a JSON or YAML document in one transaction"""
+    fmt = fmt or ('yaml' if source.name.endswith(('.yml', '.yaml')) else 'json')
+    try:
+        ids = import_storyline(parse_document(source.read(), fmt), dry_run=dry_run)
+    except StorylineImportError as e:
+        for error in e.errors:
+            click.echo(error, err=True)
+        sys.exit(1)
+
+    click.echo(f"{'Validated' if dry_run else 'Imported'} {len(ids)} storyline challenges")
+
+@storyline_cli.command('export')
+@click.argument('target', type=click.File('w'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['json', 'yaml']), default='json')
+def export_command(target, fmt):
+    """Write every storyline challenge to a JSON or YAML document"""
+    try:
+        for chunk in export_storyline(fmt):
+            target.write(chunk)
+    except StorylineImportError as e:
+        for error in e.errors:
+            click.echo(error, err=True)
+        sys.exit(1)
+
+@storyline_cli.command('timeline')
+@click.argument('target', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(TIMELINE_FORMATS), help='Defaults to the file extension, else Parquet when pyarrow is installed')
+@click.option('--until', type=click.DateTime(), help='Replay solves up to this UTC time (default now)')
+@click.option('--team', 'team_ids', type=int, multiple=True, help='Only replay these teams')
+def timeline_command(target, fmt, until, team_ids):
+    """Replay every solve and write the unlock, solve and expire timeline of each team"""
+    try:
+        count = write_timeline(replay(until=until, team_ids=team_ids or None), target, fmt)
+    except ValueError as e:
+        click.echo(str(e), err=True)
+        sys.exit(1)
+
+    click.echo(f"Wrote {count} timeline events to {target}")
+
+@storyline_cli.command('replay')
+@click.argument('target', type=click.File('w'), default='-')
+@click.option('--speed', type=float, default=10.0, show_default=True, help='Playback speed relative to the original event')
+@click.option('--until', type=click.DateTime(), help='Replay solves up to this UTC time (default now)')
+@click.option('--team', 'team_ids', type=int, multiple=True, help='Only replay these teams')
+def replay_command(target, speed, until, team_ids):
+    """Stream the timeline as NDJSON, paced like the original event, for driving load tests"""
+    if speed <= 0:
+        click.echo("--speed must be positive", err=True)
+        sys.exit(1)
+
+    for event in paced(replay(until=until, team_ids=team_ids or None), speed=speed):
+        target.write(json.dumps({
+            key: value.isoformat() if isinstance(value, datetime) else value
+            for key, value in event._asdict().items()
+        }) + '\n')
+        target.flush()
@@ -0,0 +1,153 @@
+from CTFd.models import db, Solves
+from .graph import get_graph
+from .batch import compile_graph, evaluate_many
+from .state import get_team_state
+from flask import g, has_app_context
+from datetime import datetime
+
+class StorylineEngine:
+    """Every unlock and expiry decision, made against one compiled graph snapshot
+
+    Routes, the challenge type and the manager ask the engine instead of
+    walking the graph themselves, so the rules live in CompiledGraph.rule and
+    the per-team state in TeamUnlockState, and nowhere else.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.plan = compile_graph(graph)
+
+    def rules(self, challenge_ids, team_solves):
+        """Return {challenge_id: (unlocked_at, expires_at)} for the met rules among challenge_ids"""
+        solved_at = self.plan.dense(team_solves)
+        unlocks = {}
+        for challenge_id in challenge_ids:
+            position = self.plan.index.get(challenge_id)
+            result = self.plan.rule(position, solved_at) if position is not None else None
+            if result is not None:
+                unlocks[challenge_id] = result
+        return unlocks
+
+    def evaluate_solves(self, team_solves):
+        """Evaluate every non-root challenge for {challenge_id: solved_at}"""
+        return self.plan.evaluate(team_solves)
+
+    def evaluate(self, team_id):
+        """Return the team's TeamUnlockState, cached per graph and team version"""
+        return get_team_state(team_id)
+
+    def evaluate_many(self, team_ids, solves=None, now=None):
+        """Return a BatchResult for many teams, loading their solves in one query unless given"""
+        team_ids = list(team_ids)
+        if solves is None:
+            solves = db.session.query(
+                Solves.team_id,
+                Solves.challenge_id,
+                Solves.date
+            ).filter(Solves.team_id.in_(team_ids)).all() if team_ids else []
+        return evaluate_many(self.graph, team_ids, solves, now)
+
+    def unlocked(self, team_id):
+        """Return the ids of the challenges currently open to a team"""
+        return set(self.evaluate(team_id).unlocked)
+
+    def accessible(self, team_id, challenge_id):
+        """Return (accessible, reason) for one team and challenge, memoized per request"""
+        if not self.graph.predecessors.get(challenge_id):
+            return True, None
+
+        memo = g.setdefault('storyline_access', {}) if has_app_context() else {}
+        key = (self.graph.version, team_id, challenge_id)
+        if key in memo:
+            return memo[key]
+
+        state = self.evaluate(team_id)
+        expires_at = state.expires_at.get(challenge_id)
+
+        if challenge_id in state.expired or (expires_at is not None and datetime.utcnow() > expires_at):
+            result = (False, "Challenge has expired")
+        elif challenge_id in state.unlocked:
+            result = (True, None)
+        else:
+            result = (False, "Predecessor challenge not solved")
+
+        memo[key] = result
+        return result
+
+    def scope(self, root_ids):
+        """Return the challenge ids in the storylines starting at root_ids, or None for everything"""
+        if root_ids is None:
+            return None
+        scope = set(root_ids)
+        for root_id in root_ids:
+            scope |= self.graph.descendants(root_id)
+        return scope
+
+    def player_nodes(self, state, now=None, teasers=False, scope=None):
+        """Build the player-visible nodes of a team's graph, keyed by challenge id
+
+        Only the team's frontier is serialized: solved and unlocked challenges,
+        plus with teasers the visible locked challenges one edge beyond them.
+        scope limits the result to a set of challenge ids (see scope()).
+        """
+        graph = self.graph
+        now = now or datetime.utcnow()
+        nodes = {}
+
+        reached = (state.unlocked | state.solved) & graph.nodes.keys()
+        if scope is not None:
+            reached &= scope
+
+        for challenge_id in sorted(reached):
+            node = graph.nodes[challenge_id]
+
+            status = 'solved' if challenge_id in state.solved else 'unlocked'
+            if challenge_id in state.expired:
+                status = 'expired'
+
+            time_remaining = None
+            expires_at = state.expires_at.get(challenge_id)
+            if status == 'unlocked' and expires_at is not None:
+                time_remaining = int((expires_at - now).total_seconds() / 60)
+                time_remaining = max(0, time_remaining)
+
+            nodes[challenge_id] = {
+                'id': challenge_id,
+                'name': node['name'],
+                'category': node['category'],
+                'value': node['value'],
+                'status': status,
+                'time_remaining': time_remaining,
+                'expires_at': expires_at.isoformat() if expires_at and status == 'unlocked' else None,
+                'predecessor_ids': graph.predecessors[challenge_id]
+            }
+
+        if teasers:
+            for challenge_id in sorted({child for cid in reached for child in graph.children.get(cid, [])}):
+                node = graph.nodes.get(challenge_id)
+                if challenge_id in nodes or challenge_id in state.expired or node is None or node['state'] == 'hidden':
+                    continue
+                if scope is not None and challenge_id not in scope:
+                    continue
+                nodes[challenge_id] = {
+                    'id': challenge_id,
+                    'name': node['name'],
+                    'category': node['category'],
+                    'value': node['value'],
+                    'status': 'locked',
+                    'time_remaining': None,
+                    'expires_at': None,
+                    'predecessor_ids': graph.predecessors[challenge_id]
+                }
+
+        return nodes
+
+def engine_for(graph):
+    """Return the engine of a snapshot, built once per graph version"""
+    if graph._engine is None:
+        graph._engine = StorylineEngine(graph)
+    return graph._engine
+
+def get_engine():
+    """Return the engine of the current graph snapshot"""
+    return engine_for(get_graph())
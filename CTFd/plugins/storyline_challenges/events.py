@@ -0,0 +1,49 @@
+from CTFd.models import db
+from flask import current_app, has_app_context
+from sqlalchemy import event
+import threading
+
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+def subscribe(event_name, callback):
+    """Register a callback for a storyline event ('solved', 'unlocked', 'expired', ...)"""
+    with _listeners_lock:
+        _listeners.setdefault(event_name, []).append(callback)
+
+def unsubscribe(event_name, callback):
+    """Remove a callback previously registered with subscribe()"""
+    with _listeners_lock:
+        callbacks = _listeners.get(event_name, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+def publish(event_name, **payload):
+    """Deliver an event to every callback registered in this worker"""
+    with _listeners_lock:
+        callbacks = list(_listeners.get(event_name, []))
+
+    for callback in callbacks:
+        callback(event_name, **payload)
+
+def after_commit(callback, *args, **kwargs):
+    """Run callback once the current transaction commits; dropped if it rolls back"""
+    db.session.info.setdefault('storyline_after_commit', []).append((callback, args, kwargs))
+
+def _run_after_commit(session):
+    for callback, args, kwargs in session.info.pop('storyline_after_commit', []):
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            if not has_app_context():
+                raise
+            current_app.logger.exception("Storyline post-commit hook failed")
+
+def _discard_after_rollback(session):
+    session.info.pop('storyline_after_commit', None)
+
+def register_commit_hooks():
+    """Attach the after_commit queue to the Flask-SQLAlchemy session"""
+    if not event.contains(db.session, 'after_commit', _run_after_commit):
+        event.listen(db.session, 'after_commit', _run_after_commit)
+        event.listen(db.session, 'after_rollback', _discard_after_rollback)
@@ -0,0 +1,259 @@
+from CTFd.cache import cache
+from CTFd.models import db, Challenges
+from .models import StorylineChallenge, StorylinePrerequisite
+from .caching import storyline_cache
+from flask import g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
+from collections import namedtuple
+from uuid import uuid4
+import json
+import threading
+import zlib
+
+GRAPH_VERSION_KEY = 'storyline_graph_version'
+
+NodeRow = namedtuple('NodeRow', 'id name category value state max_lifetime unlock_mode')
+EdgeRow = namedtuple('EdgeRow', 'challenge_id predecessor_id max_lifetime')
+
+_graph = None
+_graph_lock = threading.Lock()
+
+def topological_sort(predecessors):
+    """Kahn's algorithm over {node: [predecessor, ...]}, without recursion
+
+    Returns (order, cyclic): order holds every node not blocked by a cycle and
+    cyclic the nodes left once everything downstream of the cycles is peeled
+    off, i.e. the cycles themselves (and anything chained between two cycles).
+    """
+    children = {}
+    in_degree = {}
+    for node, preds in predecessors.items():
+        in_degree[node] = len(preds)
+        for predecessor in preds:
+            children.setdefault(predecessor, []).append(node)
+            in_degree.setdefault(predecessor, 0)
+
+    order = [node for node, degree in in_degree.items() if degree == 0]
+    for node in order:
+        for child in children.get(node, []):
+            in_degree[child] -= 1
+            if in_degree[child] == 0:
+                order.append(child)
+
+    remaining = {node for node, degree in in_degree.items() if degree > 0}
+    out_degree = {node: sum(1 for child in children.get(node, []) if child in remaining) for node in remaining}
+    sinks = [node for node, degree in out_degree.items() if degree == 0]
+    while sinks:
+        node = sinks.pop()
+        remaining.discard(node)
+        for predecessor in predecessors.get(node, []):
+            if predecessor in remaining:
+                out_degree[predecessor] -= 1
+                if out_degree[predecessor] == 0:
+                    sinks.append(predecessor)
+
+    return order, sorted(remaining)
+
+class StorylineGraph:
+    """Read-only snapshot of the challenge DAG for a single graph version"""
+
+    def __init__(self, version, nodes, edges):
+        self.version = version
+        self.nodes = {}
+        self.predecessors = {}
+        self.children = {}
+        self.max_lifetime = {}
+        self.unlock_mode = {}
+        self.storyline_ids = set()
+        self.edge_lifetime = {}
+        self._descendants = {}
+        self._compiled = None
+        self._engine = None
+        self._name_index = None
+
+        for row in nodes:
+            self.nodes[row.id] = {
+                'id': row.id,
+                'name': row.name,
+                'category': row.category,
+                'value': row.value,
+                'state': row.state,
+            }
+            self.predecessors[row.id] = []
+            self.children[row.id] = []
+            self.max_lifetime[row.id] = row.max_lifetime
+            self.unlock_mode[row.id] = row.unlock_mode or 'all'
+            if row.unlock_mode is not None:
+                self.storyline_ids.add(row.id)
+
+        for edge in edges:
+            if edge.challenge_id not in self.nodes:
+                continue
+            self.predecessors[edge.challenge_id].append(edge.predecessor_id)
+            self.children.setdefault(edge.predecessor_id, []).append(edge.challenge_id)
+            self.edge_lifetime[(edge.predecessor_id, edge.challenge_id)] = edge.max_lifetime
+
+        self.roots = [cid for cid, preds in self.predecessors.items() if not preds]
+        order, self.cyclic = topological_sort(self.predecessors)
+        self.acyclic = not self.cyclic
+        self.order = [cid for cid in order if cid in self.nodes]
+        self.position = {cid: index for index, cid in enumerate(self.order)}
+        self.ids = sorted(self.nodes)
+        self.index = {cid: index for index, cid in enumerate(self.ids)}
+
+    def prerequisites(self, challenge_id):
+        """Return [(predecessor_id, max_lifetime)] for the incoming edges of a challenge"""
+        return [
+            (predecessor_id, self.edge_lifetime[(predecessor_id, challenge_id)])
+            for predecessor_id in self.predecessors.get(challenge_id, [])
+        ]
+
+    def would_create_cycle(self, challenge_id, predecessor_ids):
+        """Check whether giving challenge_id these predecessors closes a cycle
+
+        Only the ancestors of the new predecessors are walked, so the cost is
+        bounded by their depth rather than by the size of the graph.
+        """
+        stack = list(predecessor_ids)
+        seen = set()
+        while stack:
+            cid = stack.pop()
+            if cid == challenge_id:
+                return True
+            if cid not in seen:
+                seen.add(cid)
+                stack.extend(self.predecessors.get(cid, []))
+        return False
+
+    def descendants(self, challenge_id):
+        """Return every challenge reachable from challenge_id, memoized per snapshot"""
+        cached = self._descendants.get(challenge_id)
+        if cached is not None:
+            return cached
+
+        reachable = set()
+        stack = list(self.children.get(challenge_id, []))
+        while stack:
+            cid = stack.pop()
+            if cid not in reachable:
+                reachable.add(cid)
+                stack.extend(self.children.get(cid, []))
+
+        reachable = frozenset(reachable)
+        self._descendants[challenge_id] = reachable
+        return reachable
+
+    @classmethod
+    def load(cls, version):
+        """Build a snapshot from the shared cache, or from the database and share it"""
+        key = f'graph:{version}'
+        if version is not None:
+            data = storyline_cache.get_shared(key)
+            if data is not None:
+                snapshot = json.loads(zlib.decompress(data))
+                return cls(
+                    version,
+                    [NodeRow(*row) for row in snapshot['nodes']],
+                    [EdgeRow(*row) for row in snapshot['edges']]
+                )
+
+        graph = cls.query(version)
+        if version is not None:
+            storyline_cache.set_shared(key, zlib.compress(json.dumps(graph.rows()).encode()))
+        return graph
+
+    def rows(self):
+        """Return the node and edge rows this snapshot was built from, as plain lists"""
+        return {
+            'nodes': [[
+                cid, node['name'], node['category'], node['value'], node['state'],
+                self.max_lifetime[cid], self.unlock_mode[cid] if cid in self.storyline_ids else None
+            ] for cid, node in self.nodes.items()],
+            'edges': [
+                [cid, predecessor_id, self.edge_lifetime[(predecessor_id, cid)]]
+                for cid, predecessors in self.predecessors.items() for predecessor_id in predecessors
+            ]
+        }
+
+    @classmethod
+    def query(cls, version):
+        """Build a snapshot from Challenges, StorylineChallenge and StorylinePrerequisite"""
+        nodes = db.session.query(
+            Challenges.id,
+            Challenges.name,
+            Challenges.category,
+            Challenges.value,
+            Challenges.state,
+            StorylineChallenge.max_lifetime,
+            StorylineChallenge.unlock_mode
+        ).outerjoin(
+            StorylineChallenge, Challenges.id == StorylineChallenge.id
+        ).order_by(Challenges.id).all()
+
+        edges = db.session.query(
+            StorylinePrerequisite.challenge_id,
+            StorylinePrerequisite.predecessor_id,
+            StorylinePrerequisite.max_lifetime
+        ).order_by(StorylinePrerequisite.challenge_id, StorylinePrerequisite.predecessor_id).all()
+
+        return cls(version, nodes, edges)
+
+def get_graph_version():
+    """Return the graph version shared by all workers through the CTFd cache, memoized per request"""
+    if has_app_context() and 'storyline_graph_version' in g:
+        return g.storyline_graph_version
+
+    version = cache.get(GRAPH_VERSION_KEY)
+    if version is None:
+        cache.add(GRAPH_VERSION_KEY, uuid4().hex, timeout=0)
+        version = cache.get(GRAPH_VERSION_KEY)
+
+    if has_app_context():
+        g.storyline_graph_version = version
+    return version
+
+def get_graph():
+    """Return this worker's graph snapshot, rebuilding it if the shared version moved"""
+    global _graph
+
+    version = get_graph_version()
+    graph = _graph
+    if graph is not None and version is not None and graph.version == version:
+        return graph
+
+    with _graph_lock:
+        graph = _graph
+        if graph is None or version is None or graph.version != version:
+            graph = StorylineGraph.load(version)
+            _graph = graph
+    return graph
+
+def invalidate_graph():
+    """Bump the shared graph version so every worker rebuilds on next access"""
+    version = uuid4().hex
+    cache.set(GRAPH_VERSION_KEY, version, timeout=0)
+    if has_app_context():
+        g.storyline_graph_version = version
+
+def _mark_challenges_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['storyline_graph_dirty'] = True
+
+def _invalidate_after_commit(session):
+    if session.info.pop('storyline_graph_dirty', False):
+        invalidate_graph()
+
+def _discard_after_rollback(session):
+    session.info.pop('storyline_graph_dirty', None)
+
+def register_graph_listeners():
+    """Invalidate the graph when challenges of any type change outside our hooks"""
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        if not event.contains(Challenges, name, _mark_challenges_changed):
+            event.listen(Challenges, name, _mark_challenges_changed, propagate=True)
+
+    if not event.contains(db.session, 'after_commit', _invalidate_after_commit):
+        event.listen(db.session, 'after_commit', _invalidate_after_commit)
+        event.listen(db.session, 'after_rollback', _discard_after_rollback)
@@ -0,0 +1,189 @@
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from functools import wraps
+import os
+import threading
+import time
+
+_local = threading.local()
+
+class Measurement:
+    """Query count, DB time and rows of one instrumented scope"""
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+class EndpointStats:
+    """Running totals for one endpoint or challenge hook"""
+
+    __slots__ = ('calls', 'queries', 'max_queries', 'db_time', 'python_time', 'max_time', 'rows')
+
+    def __init__(self):
+        self.calls = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.db_time = 0.0
+        self.python_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+
+    def to_dict(self):
+        calls = self.calls or 1
+        return {
+            'calls': self.calls,
+            'queries': self.queries,
+            'queries_per_call': round(self.queries / calls, 2),
+            'max_queries': self.max_queries,
+            'db_ms': round(self.db_time * 1000, 3),
+            'python_ms': round(self.python_time * 1000, 3),
+            'mean_ms': round((self.db_time + self.python_time) * 1000 / calls, 3),
+            'max_ms': round(self.max_time * 1000, 3),
+            'rows': self.rows
+        }
+
+class Instrumentation:
+    """Opt-in per-endpoint SQL and timing counters for the storyline plugin
+
+    Enabled with STORYLINE_INSTRUMENTATION. Queries are attributed to every
+    scope open on the current thread, so a challenge hook's queries also count
+    toward the request that called it. Counters are kept per worker process.
+    Rows come from the DBAPI rowcount, which some drivers (SQLite) do not
+    report for SELECTs.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.warn_threshold = None
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._app = None
+
+    def init_app(self, app, blueprint_name):
+        self._app = app
+        self.enabled = bool(app.config.get('STORYLINE_INSTRUMENTATION', False))
+        self.warn_threshold = app.config.get('STORYLINE_QUERY_WARN_THRESHOLD')
+        if not self.enabled:
+            return
+
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+        @app.before_request
+        def start_storyline_measurement():
+            if request.blueprint == blueprint_name:
+                g.storyline_measurement = self.start(request.endpoint)
+
+        @app.teardown_request
+        def finish_storyline_measurement(exc):
+            measurement = g.pop('storyline_measurement', None)
+            if measurement is not None:
+                self.finish(measurement)
+
+    def start(self, name):
+        measurement = Measurement(name)
+        _scopes().append(measurement)
+        return measurement
+
+    def finish(self, measurement):
+        scopes = _scopes()
+        if measurement in scopes:
+            scopes.remove(measurement)
+
+        elapsed = measurement.elapsed
+        with self._lock:
+            stats = self._stats.get(measurement.name)
+            if stats is None:
+                stats = self._stats[measurement.name] = EndpointStats()
+            stats.calls += 1
+            stats.queries += measurement.queries
+            stats.max_queries = max(stats.max_queries, measurement.queries)
+            stats.db_time += measurement.db_time
+            stats.python_time += max(0.0, elapsed - measurement.db_time)
+            stats.max_time = max(stats.max_time, elapsed)
+            stats.rows += measurement.rows
+
+        if self.warn_threshold and measurement.queries > self.warn_threshold and self._app is not None:
+            self._app.logger.warning(
+                "Storyline %s ran %d queries (threshold %d)",
+                measurement.name, measurement.queries, self.warn_threshold
+            )
+
+    def snapshot(self):
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in sorted(self._stats.items())}
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def prometheus(self):
+        """Render the counters in the Prometheus text exposition format"""
+        metrics = (
+            ('storyline_calls_total', 'counter', 'Instrumented calls', lambda s: s['calls']),
+            ('storyline_sql_queries_total', 'counter', 'SQL statements executed', lambda s: s['queries']),
+            ('storyline_sql_queries_max', 'gauge', 'Most SQL statements in a single call', lambda s: s['max_queries']),
+            ('storyline_db_seconds_total', 'counter', 'Time spent waiting on the database', lambda s: s['db_ms'] / 1000),
+            ('storyline_python_seconds_total', 'counter', 'Time spent outside the database', lambda s: s['python_ms'] / 1000),
+            ('storyline_rows_total', 'counter', 'Rows reported by the database driver', lambda s: s['rows']),
+        )
+        snapshot = self.snapshot()
+        pid = os.getpid()
+
+        lines = []
+        for metric, kind, help_text, value in metrics:
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} {kind}')
+            for name, stats in snapshot.items():
+                lines.append(f'{metric}{{endpoint="{name}",pid="{pid}"}} {value(stats)}')
+        return '\n'.join(lines) + '\n'
+
+instrumentation = Instrumentation()
+
+def _scopes():
+    scopes = getattr(_local, 'scopes', None)
+    if scopes is None:
+        scopes = _local.scopes = []
+    return scopes
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _scopes():
+        conn.info.setdefault('storyline_query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    scopes = _scopes()
+    starts = conn.info.get('storyline_query_start')
+    if not scopes or not starts:
+        return
+
+    duration = time.perf_counter() - starts.pop()
+    rows = max(0, getattr(cursor, 'rowcount', 0) or 0)
+    for measurement in scopes:
+        measurement.queries += 1
+        measurement.db_time += duration
+        measurement.rows += rows
+
+def instrumented(name):
+    """Measure a challenge hook or manager call as its own scope when instrumentation is on"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not instrumentation.enabled:
+                return f(*args, **kwargs)
+
+            measurement = instrumentation.start(name)
+            try:
+                return f(*args, **kwargs)
+            finally:
+                instrumentation.finish(measurement)
+        return wrapper
+    return decorator
@@ -1,61 +1,217 @@
-from CTFd.models import db, Challenges, Solves
-from CTFd.utils import get_config
-from .models import StorylineChallenge, SolutionDescription
-from .utils import get_unlocked_challenges_for_team
+from CTFd.models import db, Solves
+from .models import SolutionDescription, StorylineUnlock, UNLOCK_MODES
+from .graph import StorylineGraph, get_graph
+from .instrumentation import instrumented
+from .stats import rebuild_stats
+from .sqlengine import evaluation_engine, materialize_unlocks
+from .writebehind import description_queue
+from . import events
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from datetime import datetime, timedelta
 
 class StorylineManager:
     """Core business logic for managing storyline challenges"""
 
     @staticmethod
-    def unlock_challenges_for_team(team_id, solved_challenge_id):
+    def unlock_challenges_for_team(team_id, solved_challenge_id, solved_at=None):
         """Unlock child challenges when a challenge is solved"""
-        child_challenges = StorylineChallenge.query.filter_by(predecessor_id=solved_challenge_id).all()
+        from .engine import engine_for
+
+        graph = get_graph()
+        children = graph.children.get(solved_challenge_id, [])
+        if not children:
+            return []
+
+        team_solves = StorylineManager.get_team_solves(team_id)
+        if solved_at is not None:
+            team_solves[solved_challenge_id] = solved_at
+
+        existing = {cid for cid, in db.session.query(StorylineUnlock.challenge_id).filter(
+            StorylineUnlock.team_id == team_id,
+            StorylineUnlock.challenge_id.in_(children)
+        )}
 
         unlocked_challenges = []
-        for child in child_challenges:
+        for child_id, result in engine_for(graph).rules(children, team_solves).items():
+            unlock = db.session.merge(StorylineUnlock(
+                team_id=team_id,
+                challenge_id=child_id,
+                unlocked_at=result[0],
+                expires_at=result[1]
+            ))
             unlocked_challenges.append({
-                'challenge_id': child.id,
-                'max_lifetime': child.max_lifetime,
-                'unlocked_at': datetime.utcnow()
+                'challenge_id': unlock.challenge_id,
+                'max_lifetime': graph.edge_lifetime[(solved_challenge_id, child_id)],
+                'unlocked_at': unlock.unlocked_at,
+                'expires_at': unlock.expires_at,
+                'new': child_id not in existing
             })
 
         return unlocked_challenges
 
     @staticmethod
-    def check_challenge_accessibility(team_id, challenge_id):
-        """Check if a team can access a specific challenge"""
-        storyline_data = StorylineChallenge.query.filter_by(id=challenge_id).first()
+    def resync_team_unlocks(team_id, challenge_ids):
+        """Recompute one team's unlocks of the given challenges from its current solves
+
+        Returns {challenge_id: (unlocked_at, expires_at)} for the rules still met.
+        """
+        from .engine import engine_for
+
+        if not challenge_ids:
+            return {}
+
+        StorylineUnlock.query.filter(
+            StorylineUnlock.team_id == team_id,
+            StorylineUnlock.challenge_id.in_(challenge_ids)
+        ).delete(synchronize_session=False)
+
+        unlocks = engine_for(get_graph()).rules(challenge_ids, StorylineManager.get_team_solves(team_id))
+        db.session.bulk_insert_mappings(StorylineUnlock, [{
+            'team_id': team_id,
+            'challenge_id': challenge_id,
+            'unlocked_at': unlocked_at,
+            'expires_at': expires_at
+        } for challenge_id, (unlocked_at, expires_at) in unlocks.items()])
+        return unlocks
 
-        if not storyline_data or storyline_data.predecessor_id is None:
-            return True, None
+    @staticmethod
+    def expiry_for(solved_at, max_lifetime):
+        """Return the end of the unlock window opened by a predecessor solve"""
+        if not max_lifetime:
+            return None
+        return solved_at + timedelta(minutes=max_lifetime)
 
-        predecessor_solve = Solves.query.filter_by(
-            team_id=team_id,
-            challenge_id=storyline_data.predecessor_id
-        ).first()
+    @staticmethod
+    def get_team_unlocks(team_id):
+        """Get the materialized unlocks of a team as {challenge_id: (unlocked_at, expires_at)}"""
+        unlocks = db.session.query(
+            StorylineUnlock.challenge_id,
+            StorylineUnlock.unlocked_at,
+            StorylineUnlock.expires_at
+        ).filter_by(team_id=team_id).all()
 
-        if not predecessor_solve:
-            return False, "Predecessor challenge not solved"
+        return {u.challenge_id: (u.unlocked_at, u.expires_at) for u in unlocks}
 
-        if storyline_data.max_lifetime:
-            expiry_time = predecessor_solve.date + timedelta(minutes=storyline_data.max_lifetime)
-            if datetime.utcnow() > expiry_time:
-                return False, "Challenge has expired"
+    @staticmethod
+    def get_team_solves(team_id):
+        """Get the solves of a team as {challenge_id: solved_at}"""
+        solves = db.session.query(
+            Solves.challenge_id,
+            Solves.date
+        ).filter_by(team_id=team_id).all()
+
+        return {s.challenge_id: s.date for s in solves}
 
-        return True, None
+    @staticmethod
+    def resync_unlocks(challenge_id=None):
+        """Rebuild materialized unlocks from Solves, for one challenge or the whole graph
+
+        With STORYLINE_EVALUATION_ENGINE = 'sql' the rules are evaluated by the
+        database in a single INSERT ... SELECT instead of in Python.
+        """
+        from .engine import engine_for
+
+        delete_query = StorylineUnlock.query
+        if evaluation_engine() == 'sql':
+            if challenge_id is not None:
+                delete_query = delete_query.filter_by(challenge_id=challenge_id)
+            delete_query.delete(synchronize_session=False)
+            materialize_unlocks(challenge_id)
+            rebuild_stats(challenge_id)
+            return
+
+        graph = StorylineGraph.load(None)
+        engine = engine_for(graph)
+        solves_query = db.session.query(
+            Solves.team_id,
+            Solves.challenge_id,
+            Solves.date
+        ).filter(Solves.team_id.isnot(None))
+
+        if challenge_id is not None:
+            delete_query = delete_query.filter_by(challenge_id=challenge_id)
+            solves_query = solves_query.filter(Solves.challenge_id.in_(graph.predecessors.get(challenge_id, [])))
+
+        delete_query.delete(synchronize_session=False)
+
+        team_solves = {}
+        for team_id, solved_id, solved_at in solves_query:
+            team_solves.setdefault(team_id, {})[solved_id] = solved_at
+
+        mappings = []
+        for team_id, solves in team_solves.items():
+            if challenge_id is None:
+                unlocks = engine.evaluate_solves(solves)
+            else:
+                unlocks = engine.rules([challenge_id], solves)
+
+            mappings.extend({
+                'team_id': team_id,
+                'challenge_id': unlocked_id,
+                'unlocked_at': unlocked_at,
+                'expires_at': expires_at
+            } for unlocked_id, (unlocked_at, expires_at) in unlocks.items())
+
+        db.session.bulk_insert_mappings(StorylineUnlock, mappings)
+        rebuild_stats(challenge_id)
 
     @staticmethod
+    def solution_description_upsert():
+        """Return the statement inserting or replacing write-ups, for one row or an executemany batch"""
+        table = SolutionDescription.__table__
+        dialect = db.engine.dialect.name
+        if dialect in ('mysql', 'mariadb'):
+            stmt = mysql_insert(table)
+            return stmt.on_duplicate_key_update(
+                description=stmt.inserted.description,
+                submitted_at=stmt.inserted.submitted_at
+            )
+
+        insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+        stmt = insert(table)
+        return stmt.on_conflict_do_update(
+            index_elements=['team_id', 'challenge_id'],
+            set_={
+                'description': stmt.excluded.description,
+                'submitted_at': stmt.excluded.submitted_at
+            }
+        )
+
+    @staticmethod
+    def upsert_solution_description(team_id, user_id, challenge_id, description):
+        """Insert or replace a team's write-up for a challenge in a single statement"""
+        db.session.execute(StorylineManager.solution_description_upsert(), {
+            'team_id': team_id,
+            'user_id': user_id,
+            'challenge_id': challenge_id,
+            'description': description,
+            'submitted_at': datetime.utcnow()
+        })
+
+    @staticmethod
+    def save_solution_description(team_id, user_id, challenge_id, description):
+        """Upsert a write-up in the current transaction, or with write-behind on, queue it once that commits"""
+        if description_queue.enabled:
+            events.after_commit(description_queue.submit, team_id, user_id, challenge_id, description)
+        else:
+            StorylineManager.upsert_solution_description(team_id, user_id, challenge_id, description)
+
+    @staticmethod
+    @instrumented('manager.get_storyline_progress')
     def get_storyline_progress(team_id):
         """Get detailed progress through the storyline for a team"""
-        from .routes import get_unlocked_challenges_for_team
+        from .engine import get_engine
 
-        unlocked = get_unlocked_challenges_for_team(team_id)
-        solved = db.session.query(Solves.challenge_id).filter_by(team_id=team_id).all()
-        solved_ids = {s.challenge_id for s in solved}
+        engine = get_engine()
+        state = engine.evaluate(team_id)
+        unlocked = set(state.unlocked)
+        solved_ids = set(state.solved)
 
-        total_challenges = Challenges.query.count()
-        storyline_challenges = StorylineChallenge.query.count()
+        graph = engine.graph
+        total_challenges = len(graph.nodes)
+        storyline_challenges = len(graph.storyline_ids)
 
         return {
             'unlocked_count': len(unlocked),
@@ -70,15 +226,26 @@ class StorylineManager:
     def validate_storyline_integrity():
         """Validate the integrity of the storyline graph"""
         issues = []
-
-        storyline_challenges = StorylineChallenge.query.all()
-        challenge_ids = {sc.id for sc in storyline_challenges}
-
-        for sc in storyline_challenges:
-            if sc.predecessor_id and sc.predecessor_id not in challenge_ids:
-                issues.append(f"Challenge {sc.id} references non-existent predecessor {sc.predecessor_id}")
-
-            if sc.max_lifetime and sc.max_lifetime <= 0:
-                issues.append(f"Challenge {sc.id} has invalid max_lifetime: {sc.max_lifetime}")
+        graph = get_graph()
+
+        for challenge_id in graph.nodes:
+            max_lifetime = graph.max_lifetime[challenge_id]
+            if max_lifetime and max_lifetime <= 0:
+                issues.append(f"Challenge {challenge_id} has invalid max_lifetime: {max_lifetime}")
+
+            if graph.unlock_mode[challenge_id] not in UNLOCK_MODES:
+                issues.append(f"Challenge {challenge_id} has invalid unlock_mode: {graph.unlock_mode[challenge_id]}")
+
+            for predecessor_id, edge_lifetime in graph.prerequisites(challenge_id):
+                if predecessor_id not in graph.nodes:
+                    issues.append(f"Challenge {challenge_id} references non-existent predecessor {predecessor_id}")
+                if predecessor_id == challenge_id:
+                    issues.append(f"Challenge {challenge_id} lists itself as a predecessor")
+                if edge_lifetime is not None and edge_lifetime <= 0:
+                    issues.append(f"Challenge {challenge_id} has invalid max_lifetime {edge_lifetime} on predecessor {predecessor_id}")
+
+        if not graph.acyclic:
+            cyclic = sorted(set(graph.nodes) - set(graph.order))
+            issues.append(f"Storyline graph contains a cycle through challenges {cyclic}")
 
         return len(issues) == 0, issues
@@ -1,20 +1,38 @@
 from CTFd.models import db, Challenges, Teams, Users
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 
+UNLOCK_MODES = ('all', 'any')
+
+class StorylineChallengeModel(Challenges):
+    __mapper_args__ = {"polymorphic_identity": "storyline"}
+
 class StorylineChallenge(db.Model):
     __tablename__ = 'storyline_challenges'
 
     id = Column(Integer, ForeignKey('challenges.id'), primary_key=True)
-    predecessor_id = Column(Integer, ForeignKey('challenges.id'), nullable=True)
+    # Single-parent link kept in sync with the first prerequisite for older readers;
+    # storyline_prerequisites is authoritative.
+    predecessor_id = Column(Integer, ForeignKey('challenges.id'), nullable=True, index=True)
     max_lifetime = Column(Integer, nullable=True)
+    unlock_mode = Column(String(8), nullable=False, default='all', server_default='all')
 
     challenge = relationship("Challenges", foreign_keys=[id], backref="storyline_data")
     predecessor = relationship("Challenges", foreign_keys=[predecessor_id])
 
+class StorylinePrerequisite(db.Model):
+    __tablename__ = 'storyline_prerequisites'
+
+    challenge_id = Column(Integer, ForeignKey('challenges.id', ondelete='CASCADE'), primary_key=True)
+    predecessor_id = Column(Integer, ForeignKey('challenges.id', ondelete='CASCADE'), primary_key=True, index=True)
+    max_lifetime = Column(Integer, nullable=True)
+
 class SolutionDescription(db.Model):
     __tablename__ = 'solution_descriptions'
+    __table_args__ = (
+        Index('uq_solution_descriptions_team_challenge', 'team_id', 'challenge_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     team_id = Column(Integer, ForeignKey('teams.id'), nullable=False)
@@ -26,3 +44,33 @@ class SolutionDescription(db.Model):
     team = relationship("Teams", backref="solution_descriptions")
     user = relationship("Users", backref="solution_descriptions")
     challenge = relationship("Challenges", backref="solution_descriptions")
+
+class StorylineUnlock(db.Model):
+    __tablename__ = 'storyline_unlocks'
+
+    team_id = Column(Integer, ForeignKey('teams.id', ondelete='CASCADE'), primary_key=True)
+    challenge_id = Column(Integer, ForeignKey('challenges.id', ondelete='CASCADE'), primary_key=True)
+    unlocked_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=True, index=True)
+
+class StorylineNodeStats(db.Model):
+    __tablename__ = 'storyline_node_stats'
+
+    challenge_id = Column(Integer, ForeignKey('challenges.id', ondelete='CASCADE'), primary_key=True)
+    unlock_count = Column(Integer, nullable=False, default=0)
+    solve_count = Column(Integer, nullable=False, default=0)
+    expiry_count = Column(Integer, nullable=False, default=0)
+
+class StorylineSolveTimeBucket(db.Model):
+    __tablename__ = 'storyline_solve_time_buckets'
+
+    challenge_id = Column(Integer, ForeignKey('challenges.id', ondelete='CASCADE'), primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class StorylineExpiry(db.Model):
+    __tablename__ = 'storyline_expiries'
+
+    team_id = Column(Integer, ForeignKey('teams.id', ondelete='CASCADE'), primary_key=True)
+    challenge_id = Column(Integer, ForeignKey('challenges.id', ondelete='CASCADE'), primary_key=True)
+    expires_at = Column(DateTime, primary_key=True)
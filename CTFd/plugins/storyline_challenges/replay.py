@@ -0,0 +1,176 @@
+from CTFd.models import db, Solves
+from .graph import StorylineGraph
+from .engine import engine_for
+from collections import namedtuple
+from datetime import datetime
+import csv
+import heapq
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TimelineEvent = namedtuple('TimelineEvent', 'at team_id kind challenge_id expires_at')
+COLUMNS = TimelineEvent._fields
+FORMATS = ('parquet', 'csv')
+
+class _TeamSolves(dict):
+    """{dense index: solved_at} that reads as None where unsolved, as CompiledGraph.rule expects"""
+
+    def __missing__(self, position):
+        return None
+
+def replay(graph=None, until=None, team_ids=None):
+    """Stream Solves in date order through the rules and yield each team's unlock timeline
+
+    Yields TimelineEvents ordered by time: 'solved' for every solve, 'unlocked'
+    when a rule is met or re-opens, 'expired' when an open window lapses
+    without a solve. Roots are open from the start and emit no event. Windows
+    still open at until (default now) are left open.
+
+    Per team, memory holds a bitmask of solved challenges, the open and expired
+    windows, and the solve times of predecessors that still have an unsolved
+    child. A solve time is dropped once every child of its challenge is
+    solved, so the timeline itself is never held in memory.
+    """
+    graph = graph or StorylineGraph.load(None)
+    plan = engine_for(graph).plan
+    until = until or datetime.utcnow()
+
+    solved = {}
+    solves = {}
+    status = {}
+    windows = []
+
+    query = db.session.query(
+        Solves.team_id,
+        Solves.challenge_id,
+        Solves.date
+    ).filter(Solves.team_id.isnot(None), Solves.date <= until).order_by(Solves.date, Solves.id)
+    if team_ids is not None:
+        query = query.filter(Solves.team_id.in_(team_ids))
+
+    def lapse(before):
+        while windows and windows[0][0] < before:
+            expires_at, team_id, position = heapq.heappop(windows)
+            if status[team_id].get(position) == ('unlocked', expires_at):
+                status[team_id][position] = ('expired', expires_at)
+                yield TimelineEvent(expires_at, team_id, 'expired', plan.ids[position], None)
+
+    for team_id, challenge_id, solved_at in query.yield_per(1000):
+        position = plan.index.get(challenge_id)
+        mask = solved.get(team_id, 0)
+        if position is None or mask >> position & 1:
+            continue
+
+        yield from lapse(solved_at)
+        solved[team_id] = mask = mask | 1 << position
+        team_solves = solves.setdefault(team_id, _TeamSolves())
+        team_status = status.setdefault(team_id, {})
+        team_status.pop(position, None)
+        yield TimelineEvent(solved_at, team_id, 'solved', challenge_id, None)
+
+        children = graph.children.get(challenge_id, [])
+        if not _all_solved(plan, children, mask):
+            team_solves[position] = solved_at
+        for predecessor_id in graph.predecessors.get(challenge_id, []):
+            predecessor = plan.index.get(predecessor_id)
+            if predecessor in team_solves and _all_solved(plan, graph.children[predecessor_id], mask):
+                del team_solves[predecessor]
+
+        for child_id in children:
+            child = plan.index[child_id]
+            result = plan.rule(child, team_solves) if not mask >> child & 1 else None
+            if result is None:
+                continue
+
+            previous = team_status.get(child)
+            expires_at = result[1]
+            if expires_at is not None and solved_at > expires_at:
+                if previous is None or previous[0] != 'expired':
+                    team_status[child] = ('expired', expires_at)
+                    yield TimelineEvent(solved_at, team_id, 'expired', child_id, None)
+                continue
+
+            if previous == ('unlocked', expires_at):
+                continue
+            team_status[child] = ('unlocked', expires_at)
+            if expires_at is not None:
+                heapq.heappush(windows, (expires_at, team_id, child))
+            if previous is None or previous[0] != 'unlocked':
+                yield TimelineEvent(solved_at, team_id, 'unlocked', child_id, expires_at)
+
+    yield from lapse(until)
+
+def _all_solved(plan, challenge_ids, mask):
+    return all(mask >> plan.index[challenge_id] & 1 for challenge_id in challenge_ids)
+
+def write_timeline(events, target, fmt=None, batch_size=10000):
+    """Write timeline events to Parquet when pyarrow is installed, else CSV; returns the row count
+
+    fmt defaults to the target's extension. Rows are written in batches, so
+    the timeline is never held in memory.
+    """
+    if fmt is None:
+        extension = str(target).rsplit('.', 1)[-1]
+        fmt = extension if extension in FORMATS else ('parquet' if pyarrow is not None else 'csv')
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format {fmt!r}, use one of {', '.join(FORMATS)}")
+    if fmt == 'parquet' and pyarrow is None:
+        raise ValueError("Parquet timelines need pyarrow installed")
+
+    if fmt == 'csv':
+        count = 0
+        with open(target, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            for event in events:
+                writer.writerow([
+                    value.isoformat() if isinstance(value, datetime) else value for value in event
+                ])
+                count += 1
+        return count
+
+    schema = pyarrow.schema([
+        ('at', pyarrow.timestamp('us')),
+        ('team_id', pyarrow.int64()),
+        ('kind', pyarrow.string()),
+        ('challenge_id', pyarrow.int64()),
+        ('expires_at', pyarrow.timestamp('us')),
+    ])
+    count = 0
+    with pyarrow.parquet.ParquetWriter(target, schema) as writer:
+        batch = []
+        for event in events:
+            batch.append(event)
+            if len(batch) >= batch_size:
+                writer.write_table(_table(batch, schema))
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write_table(_table(batch, schema))
+            count += len(batch)
+    return count
+
+def _table(batch, schema):
+    return pyarrow.Table.from_arrays([
+        pyarrow.array(column, type=field.type) for column, field in zip(zip(*batch), schema)
+    ], schema=schema)
+
+def paced(events, speed=10.0, clock=time.monotonic, sleep=time.sleep):
+    """Re-yield timeline events at their original spacing divided by speed
+
+    The schedule depends only on the events and speed, so a replay is
+    deterministic; a consumer that falls behind is not waited for again.
+    """
+    started = origin = None
+    for event in events:
+        if origin is None:
+            origin, started = event.at, clock()
+        delay = (event.at - origin).total_seconds() / speed - (clock() - started)
+        if delay > 0:
+            sleep(delay)
+        yield event
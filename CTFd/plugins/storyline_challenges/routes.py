@@ -1,207 +1,307 @@
-from flask import Blueprint, request, jsonify, render_template
+from flask import Blueprint, Response, abort, current_app, request, jsonify, render_template, stream_with_context
 from CTFd.models import db, Challenges, Solves, Teams
-from CTFd.utils.user import get_current_team, get_current_user, is_admin
+from CTFd.cache import cache
+from CTFd.utils.user import get_current_team, get_current_team_attrs, get_current_user, is_admin
 from CTFd.utils.decorators import authed_only, admins_only
-from .models import StorylineChallenge, SolutionDescription
+from .models import SolutionDescription, StorylineUnlock
+from .manager import StorylineManager
+from .graph import get_graph
+from .engine import get_engine
+from .instrumentation import instrumentation
+from .caching import storyline_cache
+from .stats import get_stats_snapshot
+from .writebehind import description_queue
+from .bulk import StorylineImportError, export_storyline, import_storyline, parse_document
+from . import events
 from datetime import datetime, timedelta
-from sqlalchemy import and_
+from sqlalchemy import and_, exists
+import bisect
+import csv
+import hashlib
+import io
+import json
+import queue
+import time
 
 storyline_blueprint = Blueprint('storyline', __name__, url_prefix='/storyline')
 
-def get_unlocked_challenges_for_team(team_id):
-    """Get all challenges unlocked for a specific team based on their solves and time constraints"""
-    team_solves = db.session.query(
-        Solves.challenge_id,
-        Solves.date
-    ).filter_by(team_id=team_id).all()
-
-    solved_challenges = {solve.challenge_id: solve.date for solve in team_solves}
-
-    challenges = db.session.query(
-        Challenges.id,
-        StorylineChallenge.predecessor_id,
-        StorylineChallenge.max_lifetime
-    ).outerjoin(StorylineChallenge, Challenges.id == StorylineChallenge.id).all()
-
-    unlocked = set()
-
-    for challenge in challenges:
-        if challenge.predecessor_id is None:
-            unlocked.add(challenge.id)
-        elif challenge.predecessor_id in solved_challenges:
-            parent_solve_time = solved_challenges[challenge.predecessor_id]
-
-            if challenge.max_lifetime:
-                expiry_time = parent_solve_time + timedelta(minutes=challenge.max_lifetime)
-                if datetime.utcnow() <= expiry_time:
-                    unlocked.add(challenge.id)
-            else:
-                unlocked.add(challenge.id)
-
-    return unlocked
-
-def validate_challenge_graph():
+def validate_challenge_graph(graph=None):
     """Validate that the challenge graph doesn't have cycles"""
-    challenges = db.session.query(
-        StorylineChallenge.id,
-        StorylineChallenge.predecessor_id
-    ).all()
-
-    graph = {}
-    for challenge in challenges:
-        if challenge.id not in graph:
-            graph[challenge.id] = []
-        if challenge.predecessor_id:
-            if challenge.predecessor_id not in graph:
-                graph[challenge.predecessor_id] = []
-            graph[challenge.predecessor_id].append(challenge.id)
-
-    def has_cycle(node, visited, rec_stack):
-        visited[node] = True
-        rec_stack[node] = True
-
-        for neighbor in graph.get(node, []):
-            if not visited.get(neighbor, False):
-                if has_cycle(neighbor, visited, rec_stack):
-                    return True
-            elif rec_stack.get(neighbor, False):
-                return True
-
-        rec_stack[node] = False
-        return False
-
-    visited = {}
-    rec_stack = {}
-
-    for node in graph:
-        if not visited.get(node, False):
-            if has_cycle(node, visited, rec_stack):
-                return False
-
-    return True
+    graph = graph or get_graph()
+    return graph.acyclic
 
-@storyline_blueprint.route('/admin/graph', methods=['GET'])
-@admins_only
-def admin_graph():
-    challenges = db.session.query(
-        Challenges.id,
-        Challenges.name,
-        Challenges.category,
-        Challenges.value,
-        StorylineChallenge.predecessor_id,
-        StorylineChallenge.max_lifetime
-    ).outerjoin(StorylineChallenge, Challenges.id == StorylineChallenge.id).all()
+def conditional_json(etag, build_payload, timeout=300):
+    """Answer with 304 if the client holds etag, else serve cached JSON bytes for it"""
+    if etag is None:
+        return jsonify(build_payload())
 
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        key = f'storyline_body_{etag}'
+        body = cache.get(key)
+        if body is None:
+            body = json.dumps(build_payload())
+            cache.set(key, body, timeout=timeout)
+        response = current_app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def build_admin_graph(graph):
+    """Serialize every node and prerequisite edge of the graph"""
     nodes = []
     edges = []
 
-    for challenge in challenges:
+    for challenge_id, node in graph.nodes.items():
         nodes.append({
-            'id': challenge.id,
-            'name': challenge.name,
-            'category': challenge.category,
-            'value': challenge.value,
-            'max_lifetime': challenge.max_lifetime
+            'id': challenge_id,
+            'name': node['name'],
+            'category': node['category'],
+            'value': node['value'],
+            'max_lifetime': graph.max_lifetime[challenge_id],
+            'unlock_mode': graph.unlock_mode[challenge_id]
         })
 
-        if challenge.predecessor_id:
+        for predecessor_id, max_lifetime in graph.prerequisites(challenge_id):
             edges.append({
-                'from': challenge.predecessor_id,
-                'to': challenge.id,
-                'max_lifetime': challenge.max_lifetime
+                'from': predecessor_id,
+                'to': challenge_id,
+                'max_lifetime': max_lifetime
             })
 
-    return jsonify({
+    return {
         'nodes': nodes,
         'edges': edges
-    })
+    }
+
+@storyline_blueprint.route('/admin/graph', methods=['GET'])
+@admins_only
+def admin_graph():
+    graph = get_graph()
+    etag = f'admin-graph-{graph.version}' if graph.version is not None else None
+    return conditional_json(etag, lambda: build_admin_graph(graph))
+
+def build_player_edges(nodes):
+    """Build edges between player-visible nodes"""
+    return [{
+        'from': predecessor_id,
+        'to': node['id']
+    } for node in nodes.values() for predecessor_id in node['predecessor_ids'] if predecessor_id in nodes]
+
+def player_graph_etag(graph, state, now):
+    """Derive a weak ETag from the graph version, team version and expiry boundaries
+
+    The remaining minutes of each open window are part of the key, so the tag
+    changes exactly when a time_remaining value in the payload would.
+    """
+    if None in state.version:
+        return None
+
+    windows = sorted(state.open_windows())
+    next_expiry = min((expires_at for _, expires_at in windows), default=None)
+    remaining = [max(0, int((expires_at - now).total_seconds() / 60)) for _, expires_at in windows]
+    key = f'{graph.version}:{state.version[1]}:{next_expiry}:{remaining}'
+    return 'player-graph-' + hashlib.sha1(key.encode()).hexdigest()
 
 @storyline_blueprint.route('/player/graph', methods=['GET'])
 @authed_only
 def player_graph():
-    team = get_current_team()
+    """The team's frontier; ?teasers=1 adds locked next steps, ?page=&per_page= pages by storyline root"""
+    team = get_current_team_attrs()
     if not team:
         return jsonify({'error': 'Team not found'}), 404
 
-    team_solves = db.session.query(
-        Solves.challenge_id,
-        Solves.date
-    ).filter_by(team_id=team.id).all()
-
-    solved_challenges = {solve.challenge_id: solve.date for solve in team_solves}
-
-    challenges = db.session.query(
-        Challenges.id,
-        Challenges.name,
-        Challenges.category,
-        Challenges.value,
-        StorylineChallenge.predecessor_id,
-        StorylineChallenge.max_lifetime
-    ).outerjoin(StorylineChallenge, Challenges.id == StorylineChallenge.id).all()
-
-    unlocked_challenges = set()
-    expired_challenges = set()
-
-    for challenge in challenges:
-        if challenge.predecessor_id is None:
-            unlocked_challenges.add(challenge.id)
-        elif challenge.predecessor_id in solved_challenges:
-            parent_solve_time = solved_challenges[challenge.predecessor_id]
-
-            if challenge.max_lifetime:
-                expiry_time = parent_solve_time + timedelta(minutes=challenge.max_lifetime)
-                if datetime.utcnow() > expiry_time:
-                    expired_challenges.add(challenge.id)
+    engine = get_engine()
+    graph = engine.graph
+    state = engine.evaluate(team.id)
+    now = datetime.utcnow()
+    teasers = request.args.get('teasers', 0, type=int) == 1
+
+    reached = state.unlocked | state.solved
+    roots = sorted(root_id for root_id in graph.roots if root_id in reached)
+    root_id = request.args.get('root', type=int)
+    page = request.args.get('page', type=int)
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), 100)
+
+    meta = None
+    if root_id is not None:
+        root_ids = [root_id] if root_id in roots else []
+    elif page is not None:
+        page = max(page, 1)
+        root_ids = roots[(page - 1) * per_page:page * per_page]
+        meta = {
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'pages': (len(roots) + per_page - 1) // per_page,
+                'total': len(roots)
+            }
+        }
+    else:
+        root_ids = None
+    scope = engine.scope(root_ids)
+
+    def build_payload():
+        nodes = engine.player_nodes(state, now, teasers=teasers, scope=scope)
+        payload = {
+            'nodes': list(nodes.values()),
+            'edges': build_player_edges(nodes)
+        }
+        if meta is not None:
+            payload['meta'] = meta
+        return payload
+
+    etag = player_graph_etag(graph, state, now)
+    if etag is not None and (teasers or root_ids is not None):
+        etag = f'{etag}-{int(teasers)}-' + hashlib.sha1(repr(root_ids).encode()).hexdigest()[:12]
+    return conditional_json(etag, build_payload)
+
+def _sse(event_name, data):
+    return f"event: {event_name}\ndata: {json.dumps(data)}\n\n"
+
+def player_graph_stream(app, team_id):
+    """Yield Server-Sent Events with player graph deltas for one team"""
+    poll_interval = app.config.get('STORYLINE_STREAM_POLL_INTERVAL', 5)
+    heartbeat_interval = app.config.get('STORYLINE_STREAM_HEARTBEAT', 30)
+    max_duration = app.config.get('STORYLINE_STREAM_MAX_DURATION', 300)
+
+    wakeups = queue.Queue()
+
+    def wake(event_name, **payload):
+        if payload.get('team_id') == team_id:
+            wakeups.put(event_name)
+
+    for event_name in ('solved', 'unlocked', 'expired'):
+        events.subscribe(event_name, wake)
+
+    try:
+        started = last_sent = time.monotonic()
+        sent = None
+        yield 'retry: 3000\n\n'
+
+        while time.monotonic() - started < max_duration:
+            messages = []
+            with app.app_context():
+                engine = get_engine()
+                state = engine.evaluate(team_id)
+                nodes = engine.player_nodes(state)
+                now = datetime.utcnow()
+
+                if sent is None:
+                    messages.append(_sse('snapshot', {
+                        'nodes': list(nodes.values()),
+                        'edges': build_player_edges(nodes),
+                        'now': now.isoformat()
+                    }))
                 else:
-                    unlocked_challenges.add(challenge.id)
-            else:
-                unlocked_challenges.add(challenge.id)
-
-    nodes = []
-    edges = []
-
-    for challenge in challenges:
-        if challenge.id in unlocked_challenges or challenge.id in solved_challenges:
-            status = 'solved' if challenge.id in solved_challenges else 'unlocked'
-            if challenge.id in expired_challenges:
-                status = 'expired'
-
-            time_remaining = None
-            if challenge.max_lifetime and challenge.predecessor_id in solved_challenges and status == 'unlocked':
-                parent_solve_time = solved_challenges[challenge.predecessor_id]
-                expiry_time = parent_solve_time + timedelta(minutes=challenge.max_lifetime)
-                time_remaining = int((expiry_time - datetime.utcnow()).total_seconds() / 60)
-                time_remaining = max(0, time_remaining)
-
-            nodes.append({
-                'id': challenge.id,
-                'name': challenge.name,
-                'category': challenge.category,
-                'value': challenge.value,
-                'status': status,
-                'time_remaining': time_remaining
-            })
-
-            if challenge.predecessor_id and (challenge.predecessor_id in unlocked_challenges or challenge.predecessor_id in solved_challenges):
-                edges.append({
-                    'from': challenge.predecessor_id,
-                    'to': challenge.id
-                })
+                    for challenge_id, node in nodes.items():
+                        previous = sent.get(challenge_id)
+                        if previous is None or (previous['status'], previous['expires_at']) != (node['status'], node['expires_at']):
+                            messages.append(_sse(node['status'], node))
+                    for challenge_id in sent.keys() - nodes.keys():
+                        messages.append(_sse('expired' if challenge_id in state.expired else 'locked', {'id': challenge_id}))
+
+                if not messages and time.monotonic() - last_sent >= heartbeat_interval:
+                    messages.append(_sse('tick', {'now': now.isoformat()}))
+
+            sent = nodes
+            if messages:
+                last_sent = time.monotonic()
+                yield ''.join(messages)
+
+            # Local solves and the expiry scheduler wake us immediately; the poll
+            # interval only bounds how late solves made on other workers show up.
+            try:
+                wakeups.get(timeout=poll_interval)
+            except queue.Empty:
+                pass
+    finally:
+        for event_name in ('solved', 'unlocked', 'expired'):
+            events.unsubscribe(event_name, wake)
+
+@storyline_blueprint.route('/player/stream', methods=['GET'])
+@authed_only
+def player_stream():
+    team = get_current_team()
+    if not team:
+        return jsonify({'error': 'Team not found'}), 404
 
-    return jsonify({
-        'nodes': nodes,
-        'edges': edges
-    })
+    return Response(
+        player_graph_stream(current_app._get_current_object(), team.id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def name_index(graph):
+    """Return (lowercased name, id) pairs of the snapshot sorted by name, built once per version"""
+    if graph._name_index is None:
+        graph._name_index = sorted(((node['name'] or '').lower(), cid) for cid, node in graph.nodes.items())
+    return graph._name_index
+
+def search_challenges(graph, q, exclude=()):
+    """Ids matching q, prefix matches first and then substring matches, each in name order"""
+    index = name_index(graph)
+    q = q.lower()
+    if not q:
+        return [cid for _, cid in index if cid not in exclude]
+
+    start = bisect.bisect_left(index, (q,))
+    prefix = []
+    for name, cid in index[start:]:
+        if not name.startswith(q):
+            break
+        if cid not in exclude:
+            prefix.append(cid)
+
+    matched = set(prefix)
+    substring = [cid for name, cid in index if q in name and cid not in matched and cid not in exclude]
+    return prefix + substring
 
 @storyline_blueprint.route('/admin/challenges', methods=['GET'])
 @admins_only
 def get_challenges_for_dropdown():
-    challenges = Challenges.query.all()
-    return jsonify([{
-        'id': c.id,
-        'name': c.name,
-        'category': c.category
-    } for c in challenges])
+    """Search predecessor candidates by name; ?exclude_for=<id> drops choices that would close a cycle
+
+    ?id= (repeatable) looks up specific challenges instead, e.g. the current predecessors.
+    """
+    graph = get_graph()
+    lookup = request.args.getlist('id', type=int)
+    q = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    exclude_for = request.args.get('exclude_for', type=int)
+
+    def build_payload():
+        exclude = set()
+        if exclude_for is not None:
+            exclude = graph.descendants(exclude_for) | {exclude_for}
+        if lookup:
+            ids = [cid for cid in lookup if cid in graph.nodes and cid not in exclude]
+        else:
+            ids = search_challenges(graph, q, exclude)
+        page = ids[offset:offset + limit]
+
+        return {
+            'data': [{
+                'id': cid,
+                'name': graph.nodes[cid]['name'],
+                'category': graph.nodes[cid]['category']
+            } for cid in page],
+            'meta': {
+                'total': len(ids),
+                'limit': limit,
+                'offset': offset,
+                'next': offset + limit if offset + limit < len(ids) else None
+            }
+        }
+
+    etag = None
+    if graph.version is not None:
+        key = f'{graph.version}:{q.lower()}:{limit}:{offset}:{exclude_for}:{lookup}'
+        etag = 'picker-' + hashlib.sha1(key.encode()).hexdigest()
+    return conditional_json(etag, build_payload)
 
 @storyline_blueprint.route('/solution-description', methods=['POST'])
 @authed_only
@@ -219,83 +319,169 @@ def submit_solution_description():
     if not challenge_id or not description:
         return jsonify({'error': 'Challenge ID and description required'}), 400
 
-    solve = Solves.query.filter_by(
+    solved = db.session.query(Solves.id).filter_by(
         team_id=team.id,
         challenge_id=challenge_id
     ).first()
 
-    if not solve:
+    if not solved:
         return jsonify({'error': 'Challenge not solved'}), 400
 
-    existing_desc = SolutionDescription.query.filter_by(
-        team_id=team.id,
-        challenge_id=challenge_id
-    ).first()
-
-    if existing_desc:
-        existing_desc.description = description
-        existing_desc.submitted_at = datetime.utcnow()
-    else:
-        solution_desc = SolutionDescription(
-            team_id=team.id,
-            user_id=user.id,
-            challenge_id=challenge_id,
-            description=description
-        )
-        db.session.add(solution_desc)
-
+    StorylineManager.save_solution_description(team.id, user.id, challenge_id, description)
     db.session.commit()
     return jsonify({'success': True})
 
-@storyline_blueprint.route('/admin/solutions', methods=['GET'])
-@admins_only
-def get_solution_descriptions():
-    descriptions = db.session.query(
+def solution_descriptions_query(args):
+    """Build the filtered write-up query shared by the paged and streaming endpoints
+
+    With write-behind on, this worker's queued write-ups are flushed first.
+    Only while another worker has write-ups queued does the read wait, up to
+    1.5 x STORYLINE_DESCRIPTION_FLUSH_INTERVAL, for it to flush them. A worker
+    whose flush fails keeps its rows queued, so they may still be missing.
+    """
+    if description_queue.enabled:
+        description_queue.wait_for_pending()
+
+    query = db.session.query(
         SolutionDescription.id,
+        SolutionDescription.team_id,
+        SolutionDescription.challenge_id,
         SolutionDescription.description,
         SolutionDescription.submitted_at,
         Teams.name.label('team_name'),
         Challenges.name.label('challenge_name')
-    ).join(Teams).join(Challenges).all()
-
-    return jsonify([{
+    ).join(
+        Teams, Teams.id == SolutionDescription.team_id
+    ).join(
+        Challenges, Challenges.id == SolutionDescription.challenge_id
+    )
+
+    team_id = args.get('team_id', type=int)
+    challenge_id = args.get('challenge_id', type=int)
+    if team_id is not None:
+        query = query.filter(SolutionDescription.team_id == team_id)
+    if challenge_id is not None:
+        query = query.filter(SolutionDescription.challenge_id == challenge_id)
+
+    try:
+        since = datetime.fromisoformat(args['since']) if args.get('since') else None
+        until = datetime.fromisoformat(args['until']) if args.get('until') else None
+    except ValueError:
+        abort(400, description='since and until must be ISO 8601 timestamps')
+    if since is not None:
+        query = query.filter(SolutionDescription.submitted_at >= since)
+    if until is not None:
+        query = query.filter(SolutionDescription.submitted_at < until)
+
+    return query.order_by(SolutionDescription.id)
+
+def serialize_solution_description(desc):
+    return {
         'id': desc.id,
+        'team_id': desc.team_id,
         'team_name': desc.team_name,
+        'challenge_id': desc.challenge_id,
         'challenge_name': desc.challenge_name,
         'description': desc.description,
         'submitted_at': desc.submitted_at.isoformat()
-    } for desc in descriptions])
+    }
+
+@storyline_blueprint.route('/admin/solutions', methods=['GET'])
+@admins_only
+def get_solution_descriptions():
+    """Page through write-ups by id; pass meta.next back as ?after= for the next page
+
+    With write-behind on, the read first waits for every worker's queued
+    write-ups (see solution_descriptions_query).
+    """
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    after = request.args.get('after', type=int)
+
+    query = solution_descriptions_query(request.args)
+    if after is not None:
+        query = query.filter(SolutionDescription.id > after)
+    descriptions = query.limit(limit + 1).all()
+
+    has_more = len(descriptions) > limit
+    descriptions = descriptions[:limit]
+
+    return jsonify({
+        'data': [serialize_solution_description(desc) for desc in descriptions],
+        'meta': {
+            'next': descriptions[-1].id if has_more else None,
+            'limit': limit
+        }
+    })
+
+@storyline_blueprint.route('/admin/solutions/export', methods=['GET'])
+@admins_only
+def export_solution_descriptions():
+    """Stream every matching write-up as NDJSON or CSV in constant memory
+
+    With write-behind on, the export first waits for every worker's queued
+    write-ups (see solution_descriptions_query).
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+
+    rows = solution_descriptions_query(request.args).yield_per(500)
+
+    def generate_ndjson():
+        for desc in rows:
+            yield json.dumps(serialize_solution_description(desc)) + '\n'
+
+    def generate_csv():
+        fields = ['id', 'team_id', 'team_name', 'challenge_id', 'challenge_name', 'description', 'submitted_at']
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields)
+        writer.writeheader()
+        for desc in rows:
+            writer.writerow(serialize_solution_description(desc))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    if export_format == 'csv':
+        generator, mimetype = generate_csv(), 'text/csv'
+    else:
+        generator, mimetype = generate_ndjson(), 'application/x-ndjson'
+
+    return Response(
+        stream_with_context(generator),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=solution_descriptions.{export_format}'}
+    )
 
 @storyline_blueprint.route('/admin/validate-graph', methods=['GET'])
 @admins_only
 def validate_graph():
     """Validate the challenge graph for cycles and orphaned challenges"""
-    is_valid = validate_challenge_graph()
-
-    challenges = db.session.query(
-        Challenges.id,
-        Challenges.name,
-        StorylineChallenge.predecessor_id
-    ).outerjoin(StorylineChallenge, Challenges.id == StorylineChallenge.id).all()
+    graph = get_graph()
+    is_valid = validate_challenge_graph(graph)
+    _, issues = StorylineManager.validate_storyline_integrity()
 
-    root_challenges = [c for c in challenges if c.predecessor_id is None]
+    root_challenges = [graph.nodes[cid] for cid in graph.roots]
     orphaned_challenges = []
 
     if len(root_challenges) == 0:
-        orphaned_challenges = [c for c in challenges]
+        orphaned_challenges = list(graph.nodes.values())
 
     return jsonify({
         'is_valid': is_valid,
         'has_cycles': not is_valid,
+        'cyclic_challenges': graph.cyclic,
         'root_challenges_count': len(root_challenges),
-        'orphaned_challenges': [{'id': c.id, 'name': c.name} for c in orphaned_challenges]
+        'orphaned_challenges': [{'id': c['id'], 'name': c['name']} for c in orphaned_challenges],
+        'issues': issues
     })
 
 @storyline_blueprint.route('/team/<int:team_id>/unlocked', methods=['GET'])
 @admins_only
 def get_team_unlocked_challenges(team_id):
     """Get unlocked challenges for a specific team (admin view)"""
-    unlocked = get_unlocked_challenges_for_team(team_id)
+    unlocked = get_engine().unlocked(team_id)
 
     challenges = db.session.query(
         Challenges.id,
@@ -313,23 +499,151 @@ def get_team_unlocked_challenges(team_id):
 @admins_only
 def get_teams_progress():
     """Get progress overview for all teams through the storyline"""
-    teams = Teams.query.all()
-    progress_data = []
+    engine = get_engine()
+    graph = engine.graph
+    total_challenges = len(graph.nodes)
+
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+    team_ids = request.args.getlist('team_id', type=int)
+    name_filter = request.args.get('q', '').strip()
+
+    teams_query = db.session.query(Teams.id, Teams.name)
+    if team_ids:
+        teams_query = teams_query.filter(Teams.id.in_(team_ids))
+    if name_filter:
+        teams_query = teams_query.filter(Teams.name.ilike(f'%{name_filter}%'))
+
+    total_teams = teams_query.count()
+    teams = teams_query.order_by(Teams.id).offset((page - 1) * per_page).limit(per_page).all()
+    page_team_ids = [team.id for team in teams]
+
+    result = engine.evaluate_many(page_team_ids)
+    solved_counts = result.counts('solved')
+    unlocked_counts = result.counts('unlocked')
+    expired_counts = result.counts('expired')
 
+    progress_data = []
     for team in teams:
-        unlocked = get_unlocked_challenges_for_team(team.id)
-        solved = db.session.query(Solves.challenge_id).filter_by(team_id=team.id).all()
-        solved_ids = {s.challenge_id for s in solved}
-
-        total_challenges = Challenges.query.count()
+        solved_count = solved_counts.get(team.id, 0)
 
         progress_data.append({
             'team_id': team.id,
             'team_name': team.name,
-            'unlocked_count': len(unlocked),
-            'solved_count': len(solved_ids),
+            'unlocked_count': unlocked_counts.get(team.id, 0),
+            'expired_count': expired_counts.get(team.id, 0),
+            'solved_count': solved_count,
             'total_challenges': total_challenges,
-            'progress_percentage': round((len(solved_ids) / total_challenges) * 100, 2) if total_challenges > 0 else 0
+            'progress_percentage': round((solved_count / total_challenges) * 100, 2) if total_challenges > 0 else 0
         })
 
-    return jsonify(progress_data)
+    return jsonify({
+        'data': progress_data,
+        'meta': {
+            'pagination': {
+                'page': page,
+                'per_page': per_page,
+                'pages': (total_teams + per_page - 1) // per_page,
+                'total': total_teams
+            }
+        }
+    })
+
+@storyline_blueprint.route('/admin/expiring', methods=['GET'])
+@admins_only
+def get_expiring_challenges():
+    """List unlock windows that close within the next N minutes, soonest first
+
+    Read from storyline_unlocks (indexed on expires_at) so every worker
+    answers the same, whether or not its expiry thread has synced yet.
+    Windows already closed by a solve are left out.
+    """
+    minutes = max(request.args.get('minutes', 10, type=int), 0)
+    now = datetime.utcnow()
+
+    expiring = db.session.query(
+        StorylineUnlock.team_id,
+        StorylineUnlock.challenge_id,
+        StorylineUnlock.expires_at
+    ).filter(
+        StorylineUnlock.expires_at > now,
+        StorylineUnlock.expires_at <= now + timedelta(minutes=minutes),
+        ~exists().where(and_(
+            Solves.team_id == StorylineUnlock.team_id,
+            Solves.challenge_id == StorylineUnlock.challenge_id
+        ))
+    ).order_by(StorylineUnlock.expires_at, StorylineUnlock.team_id, StorylineUnlock.challenge_id)
+
+    return jsonify([{
+        'team_id': unlock.team_id,
+        'challenge_id': unlock.challenge_id,
+        'expires_at': unlock.expires_at.isoformat()
+    } for unlock in expiring])
+
+@storyline_blueprint.route('/admin/metrics', methods=['GET', 'DELETE'])
+@admins_only
+def get_metrics():
+    """Per-endpoint query and timing counters of this worker; ?format=prometheus for text exposition"""
+    if not instrumentation.enabled:
+        return jsonify({'error': 'Instrumentation is disabled, set STORYLINE_INSTRUMENTATION'}), 404
+
+    if request.method == 'DELETE':
+        instrumentation.reset()
+        return jsonify({'success': True})
+
+    if request.args.get('format') == 'prometheus':
+        return Response(instrumentation.prometheus(), mimetype='text/plain; version=0.0.4')
+    return jsonify(instrumentation.snapshot())
+
+@storyline_blueprint.route('/admin/stats', methods=['GET'])
+@admins_only
+def get_storyline_stats():
+    """Graph structure and per-challenge unlock, solve and expiry counters"""
+    return jsonify(get_stats_snapshot())
+
+@storyline_blueprint.route('/admin/cache', methods=['GET'])
+@admins_only
+def get_cache_stats():
+    """Hit rates and occupancy of this worker's storyline cache tiers"""
+    return jsonify(storyline_cache.stats())
+
+@storyline_blueprint.route('/admin/import', methods=['POST'])
+@admins_only
+def import_storyline_document():
+    """Create a whole storyline from a JSON or YAML document in one transaction; ?dry_run=1 only validates"""
+    upload = request.files.get('file')
+    if upload is not None:
+        text = upload.read().decode('utf-8')
+        fmt = 'yaml' if upload.filename.endswith(('.yml', '.yaml')) else 'json'
+    else:
+        text = request.get_data(as_text=True)
+        fmt = 'yaml' if 'yaml' in (request.mimetype or '') else 'json'
+    fmt = request.args.get('format', fmt)
+
+    try:
+        ids = import_storyline(parse_document(text, fmt), dry_run=request.args.get('dry_run', type=int) == 1)
+    except StorylineImportError as e:
+        return jsonify({'success': False, 'errors': e.errors}), 400
+
+    return jsonify({'success': True, 'created': len(ids), 'ids': ids})
+
+@storyline_blueprint.route('/admin/export', methods=['GET'])
+@admins_only
+def export_storyline_document():
+    """Stream every storyline challenge in the format accepted by /admin/import"""
+    fmt = request.args.get('format', 'json')
+    try:
+        generator = export_storyline(fmt)
+        first = next(generator)
+    except StorylineImportError as e:
+        return jsonify({'success': False, 'errors': e.errors}), 400
+
+    def generate():
+        yield first
+        yield from generator
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/json' if fmt == 'json' else 'application/x-yaml',
+        headers={'Content-Disposition': f'attachment; filename=storyline.{fmt}'}
+    )
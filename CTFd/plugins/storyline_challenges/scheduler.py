@@ -0,0 +1,122 @@
+from CTFd.models import db
+from .models import StorylineUnlock
+from . import events
+from datetime import datetime, timedelta
+import heapq
+import os
+import threading
+
+class ExpiryScheduler:
+    """Min-heap of (expires_at, team_id, challenge_id) windows, fired by a background thread"""
+
+    def __init__(self, sync_interval=60):
+        self.sync_interval = sync_interval
+        self._heap = []
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._app = None
+        self._pid = None
+        self._last_sync = None
+
+    def init_app(self, app):
+        self._app = app
+        self.sync_interval = app.config.get('STORYLINE_EXPIRY_SYNC_INTERVAL', self.sync_interval)
+
+    def ensure_running(self):
+        """Start the worker thread once per process (gunicorn forks after load())"""
+        if self._app is None or self._pid == os.getpid():
+            return
+
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._heap = []
+            self._pending = {}
+            self._last_sync = None
+
+        thread = threading.Thread(target=self._run, name='storyline-expiry', daemon=True)
+        thread.start()
+
+    def schedule(self, team_id, challenge_id, expires_at):
+        """Track a window; it fires once at expires_at unless rescheduled or cancelled"""
+        if expires_at is None or expires_at <= datetime.utcnow():
+            return
+
+        self.ensure_running()
+        key = (team_id, challenge_id)
+        with self._condition:
+            if self._pending.get(key) == expires_at:
+                return
+            self._pending[key] = expires_at
+            heapq.heappush(self._heap, (expires_at, team_id, challenge_id))
+            if self._heap[0][0] == expires_at:
+                self._condition.notify()
+
+    def cancel(self, team_id, challenge_id):
+        """Drop a window; its heap entry is discarded lazily when it surfaces"""
+        with self._condition:
+            self._pending.pop((team_id, challenge_id), None)
+
+    def cancel_challenge(self, challenge_id):
+        """Drop every team's window on a challenge, e.g. after its lifetime was edited"""
+        with self._condition:
+            for key in [key for key in self._pending if key[1] == challenge_id]:
+                del self._pending[key]
+
+    def sync(self):
+        """Load open windows committed by other workers"""
+        now = datetime.utcnow()
+        rows = db.session.query(
+            StorylineUnlock.team_id,
+            StorylineUnlock.challenge_id,
+            StorylineUnlock.expires_at
+        ).filter(StorylineUnlock.expires_at > now).all()
+        db.session.remove()
+
+        for row in rows:
+            self.schedule(row.team_id, row.challenge_id, row.expires_at)
+        self._last_sync = now
+
+    def _pop_due(self):
+        now = datetime.utcnow()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            expires_at, team_id, challenge_id = heapq.heappop(self._heap)
+            if self._pending.get((team_id, challenge_id)) == expires_at:
+                del self._pending[(team_id, challenge_id)]
+                due.append((expires_at, team_id, challenge_id))
+        return due
+
+    def _next_timeout(self):
+        now = datetime.utcnow()
+        timeout = self.sync_interval
+        if self._last_sync is not None:
+            timeout = max(0, self.sync_interval - (now - self._last_sync).total_seconds())
+        if self._heap:
+            timeout = min(timeout, max(0, (self._heap[0][0] - now).total_seconds()))
+        return timeout
+
+    def _run(self):
+        while True:
+            with self._app.app_context():
+                if self._last_sync is None or datetime.utcnow() - self._last_sync >= timedelta(seconds=self.sync_interval):
+                    try:
+                        self.sync()
+                    except Exception:
+                        self._app.logger.exception("Storyline expiry sync failed")
+                        self._last_sync = datetime.utcnow()
+
+                with self._condition:
+                    due = self._pop_due()
+                    if not due:
+                        self._condition.wait(self._next_timeout())
+                        due = self._pop_due()
+
+                for expires_at, team_id, challenge_id in due:
+                    try:
+                        events.publish('expired', team_id=team_id, challenge_id=challenge_id, expires_at=expires_at)
+                    except Exception:
+                        self._app.logger.exception("Storyline expiry listener failed")
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,93 @@
+from CTFd.models import db
+from CTFd.utils import get_config, set_config
+from .models import (
+    StorylineChallenge, StorylinePrerequisite, StorylineUnlock, SolutionDescription,
+    StorylineNodeStats, StorylineSolveTimeBucket, StorylineExpiry
+)
+from .stats import rebuild_stats
+from sqlalchemy import exists, inspect, text
+
+SCHEMA_VERSION_KEY = 'storyline_schema_version'
+
+def _has_column(table, column):
+    return column in {c['name'] for c in inspect(db.engine).get_columns(table)}
+
+def _has_index(table, name):
+    return name in {i['name'] for i in inspect(db.engine).get_indexes(table)}
+
+def add_unlock_mode():
+    """Add storyline_challenges.unlock_mode for AND/OR prerequisites"""
+    if not _has_column(StorylineChallenge.__tablename__, 'unlock_mode'):
+        db.session.execute(text(
+            "ALTER TABLE storyline_challenges ADD COLUMN unlock_mode VARCHAR(8) NOT NULL DEFAULT 'all'"
+        ))
+
+def copy_legacy_predecessors():
+    """Move single-parent predecessor_id links into storyline_prerequisites"""
+    legacy = db.session.query(
+        StorylineChallenge.id,
+        StorylineChallenge.predecessor_id,
+        StorylineChallenge.max_lifetime
+    ).filter(
+        StorylineChallenge.predecessor_id.isnot(None),
+        ~exists().where(StorylinePrerequisite.challenge_id == StorylineChallenge.id)
+    )
+    db.session.execute(StorylinePrerequisite.__table__.insert().from_select(
+        ['challenge_id', 'predecessor_id', 'max_lifetime'], legacy
+    ))
+
+def add_storyline_indexes():
+    """Index child and expiry lookups and make write-ups unique per (team, challenge)"""
+    # Keep the newest write-up of any duplicates so the unique index can be built.
+    # The derived table lets MySQL delete from the table it selects from.
+    db.session.execute(text(
+        "DELETE FROM solution_descriptions WHERE id NOT IN ("
+        "SELECT id FROM (SELECT MAX(id) AS id FROM solution_descriptions GROUP BY team_id, challenge_id) AS keep)"
+    ))
+
+    for model in (StorylineChallenge, StorylinePrerequisite, StorylineUnlock, SolutionDescription):
+        for index in model.__table__.indexes:
+            if not _has_index(model.__tablename__, index.name):
+                index.create(bind=db.session.connection())
+
+def build_statistics():
+    """Seed the incremental storyline statistics from existing unlocks and solves"""
+    rebuild_stats()
+
+MIGRATIONS = [
+    add_unlock_mode,
+    copy_legacy_predecessors,
+    add_storyline_indexes,
+    build_statistics,
+]
+
+# Tables owned by the plugin. A new table must come with a migration so that
+# schema_is_current() stops short-circuiting and create_tables() runs.
+TABLES = [
+    StorylineChallenge,
+    StorylinePrerequisite,
+    SolutionDescription,
+    StorylineUnlock,
+    StorylineNodeStats,
+    StorylineSolveTimeBucket,
+    StorylineExpiry,
+]
+
+def schema_is_current():
+    """One config read: True when every migration has already been applied"""
+    return int(get_config(SCHEMA_VERSION_KEY) or 0) >= len(MIGRATIONS)
+
+def create_tables():
+    """Create missing plugin tables without touching the rest of CTFd's metadata"""
+    db.metadata.create_all(bind=db.engine, tables=[model.__table__ for model in TABLES])
+
+def upgrade():
+    """Apply pending migrations; returns True if the schema changed"""
+    current = int(get_config(SCHEMA_VERSION_KEY) or 0)
+
+    for version, migration in enumerate(MIGRATIONS[current:], start=current + 1):
+        migration()
+        db.session.commit()
+        set_config(SCHEMA_VERSION_KEY, version)
+
+    return current < len(MIGRATIONS)
@@ -0,0 +1,96 @@
+from CTFd.models import db, Challenges, Solves
+from .models import StorylineChallenge, StorylinePrerequisite, StorylineUnlock
+from flask import current_app, has_app_context
+from sqlalchemy import DateTime, and_, case, func, or_, type_coerce
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+ENGINES = ('python', 'sql')
+
+class add_minutes(FunctionElement):
+    """timestamp + minutes, NULL when minutes is NULL, compiled per dialect"""
+    type = DateTime()
+    name = 'add_minutes'
+    inherit_cache = True
+
+@compiles(add_minutes)
+def _add_minutes_default(element, compiler, **kw):
+    moment, minutes = list(element.clauses)
+    return f"({compiler.process(moment, **kw)} + {compiler.process(minutes, **kw)} * INTERVAL '1 minute')"
+
+@compiles(add_minutes, 'mysql')
+@compiles(add_minutes, 'mariadb')
+def _add_minutes_mysql(element, compiler, **kw):
+    moment, minutes = list(element.clauses)
+    return f"DATE_ADD({compiler.process(moment, **kw)}, INTERVAL {compiler.process(minutes, **kw)} MINUTE)"
+
+@compiles(add_minutes, 'sqlite')
+def _add_minutes_sqlite(element, compiler, **kw):
+    # datetime() drops the fraction SQLAlchemy stores after the seconds; adding
+    # whole minutes leaves it unchanged, so it is appended back as-is
+    moment, minutes = list(element.clauses)
+    moment = compiler.process(moment, **kw)
+    minutes = compiler.process(minutes, **kw)
+    return f"(datetime({moment}, '+' || {minutes} || ' minutes') || substr({moment}, 20))"
+
+def evaluation_engine():
+    """Return the configured unlock evaluation engine, 'python' unless STORYLINE_EVALUATION_ENGINE says otherwise"""
+    engine = current_app.config.get('STORYLINE_EVALUATION_ENGINE', 'python') if has_app_context() else 'python'
+    return engine if engine in ENGINES else 'python'
+
+def unlocks_query(team_ids=None, challenge_id=None):
+    """Select (team_id, challenge_id, unlocked_at, expires_at) for every met unlock rule
+
+    One grouped statement joins each team's solves to the prerequisite edges
+    leaving them and applies CompiledGraph.rule in SQL: 'all'
+    needs every edge satisfied, opens on the last solve and closes with the
+    earliest window; 'any' opens on the first solve and closes with the
+    latest window, or never if any window is open-ended.
+    """
+    in_degree = db.session.query(
+        StorylinePrerequisite.challenge_id.label('challenge_id'),
+        func.count().label('edges')
+    ).group_by(StorylinePrerequisite.challenge_id).subquery()
+
+    mode = func.coalesce(StorylineChallenge.unlock_mode, 'all')
+    closes = add_minutes(Solves.date, func.nullif(StorylinePrerequisite.max_lifetime, 0))
+    any_mode = func.max(case((mode == 'any', 1), else_=0)) == 1
+
+    query = db.session.query(
+        Solves.team_id.label('team_id'),
+        StorylinePrerequisite.challenge_id.label('challenge_id'),
+        case((any_mode, func.min(Solves.date)), else_=func.max(Solves.date)).label('unlocked_at'),
+        type_coerce(case(
+            (and_(any_mode, func.count(closes) < func.count()), None),
+            (any_mode, func.max(closes)),
+            else_=func.min(closes)
+        ), DateTime).label('expires_at')
+    ).join(
+        StorylinePrerequisite, StorylinePrerequisite.predecessor_id == Solves.challenge_id
+    ).join(
+        Challenges, Challenges.id == StorylinePrerequisite.challenge_id
+    ).join(
+        in_degree, in_degree.c.challenge_id == StorylinePrerequisite.challenge_id
+    ).outerjoin(
+        StorylineChallenge, StorylineChallenge.id == StorylinePrerequisite.challenge_id
+    ).filter(
+        Solves.team_id.isnot(None)
+    ).group_by(
+        Solves.team_id, StorylinePrerequisite.challenge_id
+    ).having(or_(
+        any_mode,
+        func.count() == func.max(in_degree.c.edges)
+    ))
+
+    if team_ids is not None:
+        query = query.filter(Solves.team_id.in_(team_ids))
+    if challenge_id is not None:
+        query = query.filter(StorylinePrerequisite.challenge_id == challenge_id)
+    return query
+
+def materialize_unlocks(challenge_id=None):
+    """Write the unlocks selected by unlocks_query straight into storyline_unlocks"""
+    query = unlocks_query(challenge_id=challenge_id)
+    db.session.execute(StorylineUnlock.__table__.insert().from_select(
+        ['team_id', 'challenge_id', 'unlocked_at', 'expires_at'], query
+    ))
@@ -0,0 +1,152 @@
+from CTFd.cache import cache
+from .manager import StorylineManager
+from .graph import get_graph
+from .caching import pack_ids, storyline_cache, unpack_ids
+from .scheduler import expiry_scheduler
+from . import events
+from flask import g, has_app_context
+from datetime import datetime, timedelta
+from uuid import uuid4
+import json
+import threading
+
+TEAM_VERSION_KEY = 'storyline_team_version_{}'
+EPOCH = datetime(1970, 1, 1)
+
+_expire_lock = threading.Lock()
+
+class TeamUnlockState:
+    """Unlock state of one team, kept current by the expiry scheduler"""
+
+    def __init__(self, version, roots, unlocks, solves, now=None):
+        now = now or datetime.utcnow()
+        self.version = version
+        self.solved = set(solves)
+        self.unlocked = set(roots)
+        self.expired = set()
+        self.materialized = set(unlocks)
+        self.expires_at = {}
+
+        for challenge_id, (unlocked_at, expires_at) in unlocks.items():
+            self.expires_at[challenge_id] = expires_at
+            if expires_at is not None and now > expires_at:
+                self.expired.add(challenge_id)
+            else:
+                self.unlocked.add(challenge_id)
+
+    def expire(self, challenge_id):
+        """Move an open window to expired, called from the expiry thread
+
+        Request threads iterate these sets of the shared cached state, so new
+        sets are swapped in instead of changing them in place. expired is
+        replaced first, so a reader never sees the challenge in neither.
+        """
+        with _expire_lock:
+            if challenge_id in self.unlocked and self.expires_at.get(challenge_id) is not None:
+                self.expired = self.expired | {challenge_id}
+                self.unlocked = self.unlocked - {challenge_id}
+
+    def open_windows(self):
+        """Yield (challenge_id, expires_at) for unlocked challenges that can still expire"""
+        for challenge_id in self.unlocked:
+            expires_at = self.expires_at.get(challenge_id)
+            if expires_at is not None:
+                yield challenge_id, expires_at
+
+    def encode(self, graph):
+        """Pack the state as solved and unlocked bitsets followed by the timed windows"""
+        size = len(graph.ids)
+        windows = [
+            [challenge_id, (expires_at - EPOCH) // timedelta(microseconds=1)]
+            for challenge_id, expires_at in self.expires_at.items() if expires_at is not None
+        ]
+        return (
+            pack_ids(self.solved, graph.index, size)
+            + pack_ids(self.materialized, graph.index, size)
+            + json.dumps(windows).encode()
+        )
+
+    @classmethod
+    def decode(cls, version, graph, data, now=None):
+        width = (len(graph.ids) + 7) // 8
+        windows = {
+            challenge_id: EPOCH + timedelta(microseconds=micros)
+            for challenge_id, micros in json.loads(data[2 * width:])
+        }
+        unlocks = {
+            challenge_id: (None, windows.get(challenge_id))
+            for challenge_id in unpack_ids(data[width:2 * width], graph.ids)
+        }
+        return cls(version, graph.roots, unlocks, unpack_ids(data[:width], graph.ids), now)
+
+def _request_team_versions():
+    if not has_app_context():
+        return {}
+    if 'storyline_team_versions' not in g:
+        g.storyline_team_versions = {}
+    return g.storyline_team_versions
+
+def get_team_version(team_id):
+    """Return the shared version of a team's solve/unlock state, memoized per request"""
+    versions = _request_team_versions()
+    if team_id in versions:
+        return versions[team_id]
+
+    key = TEAM_VERSION_KEY.format(team_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, timeout=0)
+        version = cache.get(key)
+
+    versions[team_id] = version
+    return version
+
+def bump_team_version(team_id):
+    """Invalidate every worker's cached state for a team"""
+    version = uuid4().hex
+    cache.set(TEAM_VERSION_KEY.format(team_id), version, timeout=0)
+    _request_team_versions()[team_id] = version
+
+def get_team_state(team_id):
+    """Return the cached unlock state of a team, reloading it if the team or graph changed
+
+    Decoded states live in this worker's LRU; their bitset encodings are shared
+    with other workers when a shared cache is configured. Both are keyed by the
+    graph and team versions, so solves and graph edits invalidate them.
+    """
+    graph = get_graph()
+    version = (graph.version, get_team_version(team_id))
+    cacheable = None not in version
+
+    state = storyline_cache.local.get(team_id)
+    if state is not None and cacheable and state.version == version:
+        return state
+
+    shared_key = f'team:{team_id}:{version[0]}:{version[1]}'
+    data = storyline_cache.get_shared(shared_key) if cacheable else None
+    if data is not None:
+        state = TeamUnlockState.decode(version, graph, data)
+    else:
+        unlocks = StorylineManager.get_team_unlocks(team_id)
+        state = TeamUnlockState(
+            version,
+            graph.roots,
+            {cid: unlock for cid, unlock in unlocks.items() if cid in graph.nodes},
+            StorylineManager.get_team_solves(team_id)
+        )
+        if cacheable:
+            storyline_cache.set_shared(shared_key, state.encode(graph))
+
+    storyline_cache.local.set(team_id, state)
+
+    for challenge_id, expires_at in state.open_windows():
+        expiry_scheduler.schedule(team_id, challenge_id, expires_at)
+
+    return state
+
+def _expire_cached_unlock(event_name, team_id, challenge_id, **payload):
+    state = storyline_cache.local.peek(team_id)
+    if state is not None and state.expires_at.get(challenge_id) == payload.get('expires_at'):
+        state.expire(challenge_id)
+
+events.subscribe('expired', _expire_cached_unlock)
@@ -0,0 +1,250 @@
+from CTFd.cache import cache
+from CTFd.models import db, Solves
+from .models import StorylineChallenge, StorylineExpiry, StorylineNodeStats, StorylineSolveTimeBucket, StorylineUnlock
+from .graph import get_graph
+from . import events
+from flask import current_app
+from sqlalchemy import and_, exists, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime
+
+STATS_CACHE_KEY = 'storyline_stats_{}'
+BUCKET_SECONDS = 60
+MAX_BUCKET = 24 * 60
+
+def solve_time_bucket(seconds):
+    """Bucket k holds times to solve in [k, k+1) minutes; the last one, a day or more, is open-ended"""
+    return min(max(int(seconds), 0) // BUCKET_SECONDS, MAX_BUCKET)
+
+def bucket_median(buckets):
+    """Estimate the median of {bucket: count} to within a minute, interpolating inside the median bucket
+
+    A median in the open-ended last bucket is reported as its lower bound.
+    """
+    total = sum(buckets.values())
+    if not total:
+        return None
+
+    seen = 0
+    for bucket in sorted(buckets):
+        if (seen + buckets[bucket]) * 2 >= total:
+            if bucket >= MAX_BUCKET:
+                return MAX_BUCKET * BUCKET_SECONDS
+            return round((bucket + (total / 2 - seen) / buckets[bucket]) * BUCKET_SECONDS)
+        seen += buckets[bucket]
+
+def _insert(table, values):
+    dialect = db.engine.dialect.name
+    if dialect in ('mysql', 'mariadb'):
+        return mysql_insert(table).values(**values), dialect
+    insert = postgresql_insert if dialect == 'postgresql' else sqlite_insert
+    return insert(table).values(**values), dialect
+
+def _increment(table, keys, column, amount=1):
+    """Add amount to a counter column, creating its row if needed, in one statement"""
+    stmt, dialect = _insert(table, dict(keys, **{column: amount}))
+    if dialect in ('mysql', 'mariadb'):
+        stmt = stmt.on_duplicate_key_update(**{column: table.c[column] + amount})
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=list(keys), set_={column: table.c[column] + amount})
+    db.session.execute(stmt)
+
+def record_solve(team_id, challenge_id, solved_at, unlocks):
+    """Count a solve and the unlocks it caused, inside the solve's own transaction"""
+    _increment(StorylineNodeStats.__table__, {'challenge_id': challenge_id}, 'solve_count')
+    record_unlocks(unlocks)
+
+    unlocked_at = db.session.query(StorylineUnlock.unlocked_at).filter_by(
+        team_id=team_id, challenge_id=challenge_id
+    ).scalar()
+    if unlocked_at is not None:
+        _increment(StorylineSolveTimeBucket.__table__, {
+            'challenge_id': challenge_id,
+            'bucket': solve_time_bucket((solved_at - unlocked_at).total_seconds())
+        }, 'count')
+
+def record_unlocks(unlocks):
+    """Count the unlocks a solve opened for the first time"""
+    for unlock in unlocks:
+        if unlock.get('new'):
+            _increment(StorylineNodeStats.__table__, {'challenge_id': unlock['challenge_id']}, 'unlock_count')
+
+def record_expiry(team_id, challenge_id, expires_at):
+    """Count a lapsed window once, however many workers saw it lapse
+
+    The (team, challenge, expires_at) row is the claim: only the worker whose
+    insert lands increments the counter. Windows closed by a solve are skipped.
+    """
+    solved = db.session.query(exists().where(and_(
+        Solves.team_id == team_id,
+        Solves.challenge_id == challenge_id,
+        Solves.date <= expires_at
+    ))).scalar()
+    if solved:
+        return False
+
+    stmt, dialect = _insert(StorylineExpiry.__table__, {
+        'team_id': team_id,
+        'challenge_id': challenge_id,
+        'expires_at': expires_at
+    })
+    stmt = stmt.prefix_with('IGNORE') if dialect in ('mysql', 'mariadb') else stmt.on_conflict_do_nothing()
+    claimed = db.session.execute(stmt).rowcount == 1
+    if claimed:
+        _increment(StorylineNodeStats.__table__, {'challenge_id': challenge_id}, 'expiry_count')
+    return claimed
+
+def rebuild_stats(challenge_id=None):
+    """Recount the statistics of one challenge, or all, from the unlock and solve tables
+
+    Used after graph edits rewrite unlocks and when the tables are first
+    created; solves and expiries keep the counters current in between. Like
+    record_solve, only team solves are counted.
+    """
+    now = datetime.utcnow()
+
+    lapsed = db.session.query(
+        StorylineUnlock.team_id,
+        StorylineUnlock.challenge_id,
+        StorylineUnlock.expires_at
+    ).filter(
+        StorylineUnlock.expires_at <= now,
+        ~exists().where(and_(
+            Solves.team_id == StorylineUnlock.team_id,
+            Solves.challenge_id == StorylineUnlock.challenge_id,
+            Solves.date <= StorylineUnlock.expires_at
+        )),
+        ~exists().where(and_(
+            StorylineExpiry.team_id == StorylineUnlock.team_id,
+            StorylineExpiry.challenge_id == StorylineUnlock.challenge_id,
+            StorylineExpiry.expires_at == StorylineUnlock.expires_at
+        ))
+    )
+
+    node_stats = StorylineNodeStats.query
+    buckets = StorylineSolveTimeBucket.query
+    unlock_counts = db.session.query(StorylineUnlock.challenge_id, func.count()).group_by(StorylineUnlock.challenge_id)
+    solve_counts = db.session.query(Solves.challenge_id, func.count()).filter(
+        Solves.team_id.isnot(None)
+    ).group_by(Solves.challenge_id)
+    expiry_counts = db.session.query(StorylineExpiry.challenge_id, func.count()).group_by(StorylineExpiry.challenge_id)
+    solve_times = db.session.query(Solves.challenge_id, Solves.date, StorylineUnlock.unlocked_at).join(
+        StorylineUnlock, and_(
+            StorylineUnlock.team_id == Solves.team_id,
+            StorylineUnlock.challenge_id == Solves.challenge_id
+        )
+    )
+
+    if challenge_id is not None:
+        lapsed = lapsed.filter(StorylineUnlock.challenge_id == challenge_id)
+        node_stats = node_stats.filter_by(challenge_id=challenge_id)
+        buckets = buckets.filter_by(challenge_id=challenge_id)
+        unlock_counts = unlock_counts.filter(StorylineUnlock.challenge_id == challenge_id)
+        solve_counts = solve_counts.filter(Solves.challenge_id == challenge_id)
+        expiry_counts = expiry_counts.filter(StorylineExpiry.challenge_id == challenge_id)
+        solve_times = solve_times.filter(Solves.challenge_id == challenge_id)
+
+    db.session.bulk_insert_mappings(StorylineExpiry, [row._asdict() for row in lapsed])
+    node_stats.delete(synchronize_session=False)
+    buckets.delete(synchronize_session=False)
+
+    if challenge_id is None:
+        storyline_ids = {cid for cid, in db.session.query(StorylineChallenge.id)}
+    else:
+        storyline_ids = {challenge_id}
+
+    counts = {}
+    for column, query in (('unlock_count', unlock_counts), ('solve_count', solve_counts), ('expiry_count', expiry_counts)):
+        for cid, count in query:
+            if cid in storyline_ids:
+                counts.setdefault(cid, {'challenge_id': cid, 'unlock_count': 0, 'solve_count': 0, 'expiry_count': 0})[column] = count
+
+    histogram = {}
+    for cid, solved_at, unlocked_at in solve_times:
+        if cid not in storyline_ids:
+            continue
+        key = (cid, solve_time_bucket((solved_at - unlocked_at).total_seconds()))
+        histogram[key] = histogram.get(key, 0) + 1
+
+    db.session.bulk_insert_mappings(StorylineNodeStats, list(counts.values()))
+    db.session.bulk_insert_mappings(StorylineSolveTimeBucket, [
+        {'challenge_id': cid, 'bucket': bucket, 'count': count} for (cid, bucket), count in histogram.items()
+    ])
+
+def graph_structure(graph):
+    """Depth, branching and size of a graph snapshot, computed once per version"""
+    key = STATS_CACHE_KEY.format(f'structure_{graph.version}')
+    structure = cache.get(key) if graph.version is not None else None
+    if structure is not None:
+        return structure
+
+    depth = {}
+    for cid in graph.order:
+        depth[cid] = max((depth.get(p, 0) + 1 for p in graph.predecessors[cid]), default=0)
+
+    storyline = graph.storyline_ids
+    branching = [len(graph.children.get(cid, [])) for cid in storyline if graph.children.get(cid)]
+    structure = {
+        'challenges': len(graph.nodes),
+        'storyline_challenges': len(storyline),
+        'edges': len(graph.edge_lifetime),
+        'timed_edges': sum(1 for lifetime in graph.edge_lifetime.values() if lifetime),
+        'roots': sum(1 for cid in storyline if not graph.predecessors[cid]),
+        'leaves': sum(1 for cid in storyline if not graph.children.get(cid)),
+        'depth': max(depth.values(), default=0),
+        'branching_factor': round(sum(branching) / len(branching), 2) if branching else 0,
+        'max_branching': max(branching, default=0),
+        'any_mode': sum(1 for cid in storyline if graph.unlock_mode[cid] == 'any'),
+        'acyclic': graph.acyclic
+    }
+    if graph.version is not None:
+        cache.set(key, structure, timeout=0)
+    return structure
+
+def get_stats_snapshot():
+    """Graph structure plus per-node counters, cached for STORYLINE_STATS_TTL seconds"""
+    graph = get_graph()
+    key = STATS_CACHE_KEY.format(graph.version)
+    snapshot = cache.get(key) if graph.version is not None else None
+    if snapshot is not None:
+        return snapshot
+
+    histograms = {}
+    for row in StorylineSolveTimeBucket.query:
+        histograms.setdefault(row.challenge_id, {})[row.bucket] = row.count
+
+    nodes = []
+    for row in StorylineNodeStats.query.order_by(StorylineNodeStats.challenge_id):
+        node = graph.nodes.get(row.challenge_id)
+        if node is None:
+            continue
+        nodes.append({
+            'challenge_id': row.challenge_id,
+            'name': node['name'],
+            'unlock_count': row.unlock_count,
+            'solve_count': row.solve_count,
+            'expiry_count': row.expiry_count,
+            'solve_rate': round(row.solve_count / row.unlock_count, 4) if row.unlock_count else None,
+            'median_seconds_to_solve': bucket_median(histograms.get(row.challenge_id, {}))
+        })
+
+    snapshot = {
+        'generated_at': datetime.utcnow().isoformat(),
+        'graph': graph_structure(graph),
+        'nodes': nodes
+    }
+    if graph.version is not None:
+        cache.set(key, snapshot, timeout=current_app.config.get('STORYLINE_STATS_TTL', 10))
+    return snapshot
+
+def _count_expiry(event_name, team_id, challenge_id, expires_at, **payload):
+    try:
+        if record_expiry(team_id, challenge_id, expires_at):
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+events.subscribe('expired', _count_expiry)
@@ -1,36 +1,60 @@
 from CTFd.models import db
-from .models import StorylineChallenge, SolutionDescription
+from .models import StorylineChallenge, StorylinePrerequisite, SolutionDescription, StorylineUnlock
+from .manager import StorylineManager
+from .graph import get_graph, invalidate_graph
+from .schema import create_tables, schema_is_current, upgrade
+from sqlalchemy import inspect
 
 def init_db():
-    """Initialize database tables for storyline challenges"""
-    db.create_all()
+    """Initialize database tables for storyline challenges
+
+    Workers booting against an up-to-date schema only read the schema version;
+    table creation and reflection happen once, when migrations are pending.
+    """
+    if schema_is_current():
+        return
+
+    unlocks_exist = inspect(db.engine).has_table(StorylineUnlock.__tablename__)
+    create_tables()
+    schema_changed = upgrade()
+
+    if not unlocks_exist:
+        StorylineManager.resync_unlocks()
+        db.session.commit()
+    if schema_changed or not unlocks_exist:
+        invalidate_graph()
 
 def get_challenge_dependencies():
     """Get a dictionary mapping challenge IDs to their dependencies"""
     dependencies = {}
     storyline_challenges = StorylineChallenge.query.all()
+    prerequisites = {}
+    for p in StorylinePrerequisite.query.all():
+        prerequisites.setdefault(p.challenge_id, []).append({
+            'predecessor_id': p.predecessor_id,
+            'max_lifetime': p.max_lifetime
+        })
 
     for sc in storyline_challenges:
         dependencies[sc.id] = {
             'predecessor_id': sc.predecessor_id,
-            'max_lifetime': sc.max_lifetime
+            'max_lifetime': sc.max_lifetime,
+            'unlock_mode': sc.unlock_mode,
+            'prerequisites': prerequisites.get(sc.id, [])
         }
 
     return dependencies
 
 def calculate_storyline_stats():
     """Calculate statistics about the storyline graph"""
-    from CTFd.models import Challenges
-
-    total_challenges = Challenges.query.count()
-    storyline_challenges = StorylineChallenge.query.count()
-    root_challenges = StorylineChallenge.query.filter_by(predecessor_id=None).count()
-    timed_challenges = StorylineChallenge.query.filter(StorylineChallenge.max_lifetime.isnot(None)).count()
+    graph = get_graph()
+    total_challenges = len(graph.nodes)
+    storyline_challenges = len(graph.storyline_ids)
 
     return {
         'total_challenges': total_challenges,
         'storyline_challenges': storyline_challenges,
-        'root_challenges': root_challenges,
-        'timed_challenges': timed_challenges,
+        'root_challenges': sum(1 for cid in graph.storyline_ids if not graph.predecessors[cid]),
+        'timed_challenges': sum(1 for cid in graph.storyline_ids if graph.max_lifetime[cid] is not None),
         'regular_challenges': total_challenges - storyline_challenges
     }
@@ -0,0 +1,168 @@
+from CTFd.cache import cache
+from CTFd.models import db
+from flask import has_app_context
+from datetime import datetime
+import atexit
+import os
+import threading
+import time
+
+PENDING_UNTIL_KEY = 'storyline_descriptions_pending_until_{}'
+WORKER_COUNTER_KEY = 'storyline_descriptions_workers'
+WORKER_SLOTS = 64
+
+class DescriptionQueue:
+    """Write-behind buffer of solution description upserts, flushed in batches by a background thread
+
+    Pending writes are keyed by (team_id, challenge_id), so a newer write-up
+    replaces a queued one (last write wins). A flush runs once
+    STORYLINE_DESCRIPTION_BATCH_SIZE writes are pending or every
+    STORYLINE_DESCRIPTION_FLUSH_INTERVAL seconds, as one executemany upsert,
+    and once more at interpreter exit.
+
+    Each worker buffers its own writes. So that readers in any worker see
+    them, a worker holding queued write-ups publishes under its own slot in
+    the shared cache a time by which they are flushed, and clears it once its
+    queue is empty. wait_for_pending() waits for the other workers' slots
+    only. Beyond WORKER_SLOTS live workers, two may share a slot.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=2.0):
+        self.enabled = False
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._app = None
+        self._pid = None
+        self._published_until = 0
+        self._slot = None
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = bool(app.config.get('STORYLINE_DESCRIPTION_WRITE_BEHIND', False))
+        self.batch_size = app.config.get('STORYLINE_DESCRIPTION_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('STORYLINE_DESCRIPTION_FLUSH_INTERVAL', self.flush_interval)
+        if self.enabled:
+            atexit.register(self.flush)
+
+    def ensure_running(self):
+        """Start the flush thread once per process (gunicorn forks after load())"""
+        if self._app is None or self._pid == os.getpid():
+            return
+
+        with self._condition:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pending = {}
+            self._published_until = 0
+            self._slot = None
+        self._slot = None
+
+        thread = threading.Thread(target=self._run, name='storyline-descriptions', daemon=True)
+        thread.start()
+
+    def submit(self, team_id, user_id, challenge_id, description):
+        """Queue a write-up, replacing any queued one of the same team and challenge"""
+        self.ensure_running()
+        with self._condition:
+            self._pending[(team_id, challenge_id)] = {
+                'team_id': team_id,
+                'user_id': user_id,
+                'challenge_id': challenge_id,
+                'description': description,
+                'submitted_at': datetime.utcnow()
+            }
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify()
+        self._publish_pending()
+
+    def _publish_pending(self):
+        """Tell other workers this one holds write-ups until at most one flush interval from now
+
+        The published time carries half an interval of slack, so the cache is
+        written at most twice per interval rather than on every submit.
+        """
+        now = time.time()
+        if self._published_until >= now + self.flush_interval:
+            return
+        if self._slot is None:
+            self._slot = (cache.cache.inc(WORKER_COUNTER_KEY) or 0) % WORKER_SLOTS
+        self._published_until = now + self.flush_interval * 1.5
+        cache.set(PENDING_UNTIL_KEY.format(self._slot), self._published_until, timeout=int(self.flush_interval * 2) + 1)
+
+    def _clear_pending(self):
+        """Withdraw this worker's published time once its queue is empty"""
+        with self._condition:
+            if self._pending or not self._published_until:
+                return
+            self._published_until = 0
+            cache.delete(PENDING_UNTIL_KEY.format(self._slot))
+
+    def wait_for_pending(self):
+        """Flush this worker's write-ups, then wait only if another worker still holds some"""
+        self.flush()
+        keys = [PENDING_UNTIL_KEY.format(slot) for slot in range(WORKER_SLOTS) if slot != self._slot]
+        deadline = time.time() + self.flush_interval * 1.5
+        while True:
+            pending_until = max((until for until in cache.get_many(*keys) if until), default=None)
+            if pending_until is None:
+                return
+            remaining = min(pending_until, deadline) - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, self.flush_interval / 10))
+
+    def discard_challenge(self, challenge_id):
+        """Drop queued write-ups of a challenge that is being deleted"""
+        with self._condition:
+            for key in [key for key in self._pending if key[1] == challenge_id]:
+                del self._pending[key]
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """Write every queued write-up in one statement; returns the number written
+
+        The write runs in its own transaction, never the caller's session.
+        Rows are put back if it fails, unless a newer write-up for the same
+        team and challenge was queued in the meantime.
+        """
+        if self._app is None:
+            return 0
+        if not has_app_context():
+            with self._app.app_context():
+                return self.flush()
+
+        from .manager import StorylineManager
+
+        with self._flush_lock:
+            with self._condition:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                self._clear_pending()
+                return 0
+
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(StorylineManager.solution_description_upsert(), list(batch.values()))
+            except Exception:
+                with self._condition:
+                    for key, values in batch.items():
+                        self._pending.setdefault(key, values)
+                self._app.logger.exception("Storyline description flush failed")
+                return 0
+            self._clear_pending()
+            return len(batch)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._pending) < self.batch_size:
+                    self._condition.wait(self.flush_interval)
+            self.flush()
+
+description_queue = DescriptionQueue()
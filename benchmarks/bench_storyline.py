@@ -0,0 +1,462 @@
+"""Benchmark and load-test suite for the storyline challenges plugin.
+
+Seeds a throwaway CTFd database with a synthetic storyline and measures the
+plugin's hot paths: latency (p50/p99), throughput and SQL queries per call.
+Results are written as JSON so runs can be compared across changes.
+
+    python benchmarks/bench_storyline.py --preset small --output before.json
+    python benchmarks/bench_storyline.py --challenges 5000 --teams 200 --shape fanout
+    python benchmarks/bench_storyline.py --preset small --output after.json --compare before.json
+
+Runs against a temporary SQLite file by default; set
+STORYLINE_BENCH_DATABASE_URL to point at a local Postgres or MySQL instead.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from CTFd import create_app
+from CTFd.config import TestingConfig
+from CTFd.models import db, Challenges, Flags, Solves, Submissions, Teams, Users
+from CTFd.utils import set_config
+from CTFd.utils.crypto import hash_password
+from sqlalchemy import event
+
+PRESETS = {
+    'small': {'challenges': 1000, 'teams': 10},
+    'medium': {'challenges': 10000, 'teams': 500},
+    'large': {'challenges': 50000, 'teams': 5000},
+}
+SHAPES = ('chain', 'fanout', 'dag')
+PASSWORD = 'benchmark'
+CHUNK = 5000
+
+class QueryCounter:
+    """Counts statements sent to the database"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+def build_storyline(shape, size, fanout, rng):
+    """Return {challenge_id: (unlock_mode, [(predecessor_id, max_lifetime)])} for ids 1..size"""
+    rules = {}
+    roots = max(1, size // 100)
+
+    for cid in range(1, size + 1):
+        if shape == 'chain':
+            predecessors = [cid - 1] if cid > 1 else []
+        elif shape == 'fanout':
+            predecessors = [(cid - 2) // fanout + 1] if cid > 1 else []
+        elif cid <= roots:
+            predecessors = []
+        else:
+            window = range(max(1, cid - 50), cid)
+            predecessors = rng.sample(window, k=min(rng.randint(1, 3), len(window)))
+
+        lifetime = rng.choice([30, 60, 240]) if predecessors and rng.random() < 0.3 else None
+        mode = 'any' if len(predecessors) > 1 and rng.random() < 0.5 else 'all'
+        rules[cid] = (mode, [(p, lifetime) for p in predecessors])
+
+    return rules
+
+def simulate_solves(rules, teams, solves_per_team, rng):
+    """Walk each team through the storyline and return [(team_id, challenge_id, date)]"""
+    children = {}
+    for cid, (_, prerequisites) in rules.items():
+        for predecessor_id, _ in prerequisites:
+            children.setdefault(predecessor_id, []).append(cid)
+    roots = [cid for cid, (_, prerequisites) in rules.items() if not prerequisites]
+
+    solves = []
+    start = datetime.utcnow() - timedelta(hours=3)
+    for team_id in range(1, teams + 1):
+        solved = set()
+        frontier = list(roots)
+        date = start + timedelta(seconds=rng.randint(0, 600))
+
+        for _ in range(rng.randint(0, solves_per_team)):
+            if not frontier:
+                break
+            cid = frontier.pop(rng.randrange(len(frontier)))
+            solved.add(cid)
+            date += timedelta(seconds=rng.randint(30, 900))
+            solves.append((team_id, cid, date))
+
+            for child_id in children.get(cid, []):
+                mode, prerequisites = rules[child_id]
+                done = [p in solved for p, _ in prerequisites]
+                if child_id not in solved and child_id not in frontier and (all(done) if mode == 'all' else any(done)):
+                    frontier.append(child_id)
+
+    return solves
+
+def insert_chunked(table, rows):
+    for offset in range(0, len(rows), CHUNK):
+        db.session.execute(table.insert(), rows[offset:offset + CHUNK])
+
+def seed(app, args, rng):
+    from CTFd.plugins.storyline_challenges.graph import invalidate_graph
+    from CTFd.plugins.storyline_challenges.manager import StorylineManager
+    from CTFd.plugins.storyline_challenges.models import StorylineChallenge, StorylinePrerequisite
+
+    rules = build_storyline(args.shape, args.challenges, args.fanout, rng)
+    solves = simulate_solves(rules, args.teams, args.solves_per_team, rng)
+    password = hash_password(PASSWORD)
+
+    with app.app_context():
+        set_config('setup', True)
+        set_config('user_mode', 'teams')
+        set_config('ctf_name', 'storyline-bench')
+
+        insert_chunked(Challenges.__table__, [{
+            'id': cid,
+            'name': f'challenge-{cid}',
+            'description': f'Synthetic challenge {cid}',
+            'category': f'act-{cid % 7}',
+            'value': 100,
+            'type': 'storyline',
+            'state': 'visible'
+        } for cid in rules])
+        insert_chunked(Flags.__table__, [{
+            'challenge_id': cid,
+            'type': 'static',
+            'content': f'flag{{{cid}}}',
+            'data': ''
+        } for cid in rules])
+        insert_chunked(StorylineChallenge.__table__, [{
+            'id': cid,
+            'predecessor_id': prerequisites[0][0] if prerequisites else None,
+            'max_lifetime': prerequisites[0][1] if prerequisites else None,
+            'unlock_mode': mode
+        } for cid, (mode, prerequisites) in rules.items()])
+        insert_chunked(StorylinePrerequisite.__table__, [{
+            'challenge_id': cid,
+            'predecessor_id': predecessor_id,
+            'max_lifetime': lifetime
+        } for cid, (_, prerequisites) in rules.items() for predecessor_id, lifetime in prerequisites])
+
+        insert_chunked(Teams.__table__, [{
+            'id': team_id,
+            'name': f'team-{team_id}',
+            'email': f'team-{team_id}@bench.local',
+            'password': password
+        } for team_id in range(1, args.teams + 1)])
+        insert_chunked(Users.__table__, [{
+            'id': team_id,
+            'name': f'user-{team_id}',
+            'email': f'user-{team_id}@bench.local',
+            'password': password,
+            'type': 'user',
+            'verified': True,
+            'team_id': team_id
+        } for team_id in range(1, args.teams + 1)] + [{
+            'id': args.teams + 1,
+            'name': 'admin',
+            'email': 'admin@bench.local',
+            'password': password,
+            'type': 'admin',
+            'verified': True
+        }])
+
+        insert_chunked(Submissions.__table__, [{
+            'id': solve_id,
+            'challenge_id': cid,
+            'user_id': team_id,
+            'team_id': team_id,
+            'ip': '127.0.0.1',
+            'provided': f'flag{{{cid}}}',
+            'type': 'correct',
+            'date': date
+        } for solve_id, (team_id, cid, date) in enumerate(solves, start=1)])
+        insert_chunked(Solves.__table__, [{
+            'id': solve_id,
+            'challenge_id': cid,
+            'user_id': team_id,
+            'team_id': team_id
+        } for solve_id, (team_id, cid, date) in enumerate(solves, start=1)])
+
+        StorylineManager.resync_unlocks()
+        db.session.commit()
+        invalidate_graph()
+
+    return rules, solves
+
+def login(app, name):
+    client = app.test_client()
+    client.get('/login')
+    with client.session_transaction() as sess:
+        nonce = sess.get('nonce')
+    client.post('/login', data={'name': name, 'password': PASSWORD, 'nonce': nonce})
+    return client
+
+def summarize(samples, queries):
+    samples = sorted(samples)
+    mean = statistics.mean(samples)
+    return {
+        'runs': len(samples),
+        'p50_ms': round(statistics.median(samples), 3),
+        'p99_ms': round(samples[int(0.99 * (len(samples) - 1))], 3),
+        'mean_ms': round(mean, 3),
+        'throughput_per_s': round(1000 / mean, 1) if mean else None,
+        'queries_per_call': round(statistics.mean(queries), 2),
+        'max_queries': max(queries),
+    }
+
+def measure(fn, iterations, counter, setup=None):
+    samples = []
+    queries = []
+    for i in range(iterations):
+        if setup is not None:
+            setup(i)
+        before = counter.count
+        start = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - start) * 1000)
+        queries.append(counter.count - before)
+    return summarize(samples, queries)
+
+def run_benchmarks(app, args, rng, counter):
+    from CTFd.plugins.storyline_challenges.challenge_type import StorylineChallengeType
+    from CTFd.plugins.storyline_challenges.engine import get_engine
+    from CTFd.plugins.storyline_challenges.graph import invalidate_graph
+    from CTFd.plugins.storyline_challenges.manager import StorylineManager
+    from CTFd.plugins.storyline_challenges.replay import replay
+    from CTFd.plugins.storyline_challenges.routes import validate_challenge_graph
+    from CTFd.plugins.storyline_challenges.state import bump_team_version, get_team_state
+
+    results = {}
+    team_ids = [rng.randint(1, args.teams) for _ in range(args.iterations)]
+
+    def unlocked(i):
+        with app.app_context():
+            get_engine().unlocked(team_ids[i])
+
+    def bump(i):
+        with app.app_context():
+            bump_team_version(team_ids[i])
+
+    results['get_unlocked_challenges_for_team.cold'] = measure(unlocked, args.iterations, counter, setup=bump)
+    results['get_unlocked_challenges_for_team.warm'] = measure(unlocked, args.iterations, counter)
+
+    def accessible(i):
+        with app.app_context():
+            get_engine().accessible(team_ids[i], rng.randint(1, args.challenges))
+
+    results['check_challenge_accessibility'] = measure(accessible, args.iterations, counter)
+
+    clients = [(team_id, login(app, f'user-{team_id}')) for team_id in sorted(set(team_ids))[:args.clients]]
+    etags = {}
+
+    def player_graph(i):
+        team_id, client = clients[i % len(clients)]
+        response = client.get('/storyline/player/graph')
+        etags[team_id] = response.headers.get('ETag')
+
+    def player_graph_not_modified(i):
+        team_id, client = clients[i % len(clients)]
+        client.get('/storyline/player/graph', headers={'If-None-Match': etags.get(team_id) or ''})
+
+    results['player_graph'] = measure(player_graph, args.iterations, counter)
+    results['player_graph.304'] = measure(player_graph_not_modified, args.iterations, counter)
+
+    admin = login(app, 'admin')
+    pages = max(1, (args.teams + 99) // 100)
+
+    def teams_progress(i):
+        admin.get(f'/storyline/admin/progress?per_page=100&page={i % pages + 1}')
+
+    results['get_teams_progress'] = measure(teams_progress, args.iterations, counter)
+
+    def invalidate(i):
+        with app.app_context():
+            invalidate_graph()
+
+    def validate(i):
+        with app.app_context():
+            validate_challenge_graph()
+
+    results['validate_challenge_graph.cold'] = measure(validate, max(1, args.iterations // 10), counter, setup=invalidate)
+
+    def resync_with(engine):
+        def resync(i):
+            app.config['STORYLINE_EVALUATION_ENGINE'] = engine
+            with app.app_context():
+                StorylineManager.resync_unlocks()
+                db.session.commit()
+        return resync
+
+    for engine in ('python', 'sql'):
+        results[f'resync_unlocks.{engine}'] = measure(resync_with(engine), max(1, args.iterations // 50), counter)
+    app.config['STORYLINE_EVALUATION_ENGINE'] = 'python'
+
+    def replay_timeline(i):
+        with app.app_context():
+            for _ in replay():
+                pass
+
+    results['replay'] = measure(replay_timeline, max(1, args.iterations // 50), counter)
+
+    samples = []
+    queries = []
+    for i in range(args.iterations):
+        team_id = team_ids[i]
+        with app.test_request_context('/', method='POST', data={'submission': 'flag'}):
+            state = get_team_state(team_id)
+            candidates = sorted(state.unlocked - state.solved)
+            if not candidates:
+                continue
+            challenge = Challenges.query.filter_by(id=rng.choice(candidates)).first()
+            team = Teams.query.filter_by(id=team_id).first()
+            user = Users.query.filter_by(id=team_id).first()
+
+            from flask import request
+            before = counter.count
+            start = time.perf_counter()
+            StorylineChallengeType.solve(user, team, challenge, request)
+            samples.append((time.perf_counter() - start) * 1000)
+            queries.append(counter.count - before)
+    if samples:
+        results['StorylineChallengeType.solve'] = summarize(samples, queries)
+
+    return results
+
+def check_engines(app):
+    """Differential check: the SQL engine must select exactly the unlocks the Python rules compute"""
+    from CTFd.plugins.storyline_challenges.engine import engine_for
+    from CTFd.plugins.storyline_challenges.graph import StorylineGraph
+    from CTFd.plugins.storyline_challenges.sqlengine import unlocks_query
+
+    with app.app_context():
+        engine = engine_for(StorylineGraph.load(None))
+        team_solves = {}
+        for team_id, challenge_id, date in db.session.query(Solves.team_id, Solves.challenge_id, Solves.date):
+            team_solves.setdefault(team_id, {})[challenge_id] = date
+
+        expected = {
+            (team_id, challenge_id, unlocked_at, expires_at)
+            for team_id, solves in team_solves.items()
+            for challenge_id, (unlocked_at, expires_at) in engine.evaluate_solves(solves).items()
+        }
+        selected = {
+            (row.team_id, row.challenge_id, row.unlocked_at, row.expires_at) for row in unlocks_query()
+        }
+
+    return len(expected ^ selected)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Print p50/p99 ratios against a baseline run; returns the names that regressed"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        for metric in ('p50_ms', 'p99_ms', 'queries_per_call'):
+            before, after = previous[metric], current[metric]
+            ratio = after / before if before else (1.0 if not after else float('inf'))
+            flag = ''
+            if ratio > tolerance:
+                flag = '  REGRESSION'
+                regressions.append(f'{name}.{metric}')
+            print(f'{name:45} {metric:17} {before:>10} -> {after:>10} ({ratio:.2f}x){flag}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=sorted(PRESETS))
+    parser.add_argument('--challenges', type=int, default=1000)
+    parser.add_argument('--teams', type=int, default=10)
+    parser.add_argument('--shape', choices=SHAPES, default='dag')
+    parser.add_argument('--fanout', type=int, default=8, help='children per node for --shape fanout')
+    parser.add_argument('--solves-per-team', type=int, default=30)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=20, help='logged-in player sessions to rotate through')
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--output', help='write results JSON here instead of stdout')
+    parser.add_argument('--compare', help='baseline results JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='ratio above which --compare flags a regression')
+    args = parser.parse_args()
+
+    if args.preset:
+        for key, value in PRESETS[args.preset].items():
+            setattr(args, key, value)
+
+    workdir = tempfile.mkdtemp(prefix='storyline-bench-')
+    database_url = os.environ.get('STORYLINE_BENCH_DATABASE_URL') or f'sqlite:///{workdir}/bench.db'
+
+    class BenchmarkConfig(TestingConfig):
+        SQLALCHEMY_DATABASE_URI = database_url
+        SAFE_MODE = False
+        CACHE_TYPE = 'simple'
+        CACHE_THRESHOLD = 1000000
+
+    app = create_app(BenchmarkConfig)
+    rng = random.Random(args.seed)
+
+    seed_started = time.perf_counter()
+    rules, solves = seed(app, args, rng)
+    seed_seconds = time.perf_counter() - seed_started
+
+    counter = QueryCounter()
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    engine_mismatches = check_engines(app)
+    results = run_benchmarks(app, args, rng, counter)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.utcnow().isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'database': database_url.split(':', 1)[0],
+            'shape': args.shape,
+            'challenges': args.challenges,
+            'edges': sum(len(prerequisites) for _, prerequisites in rules.values()),
+            'teams': args.teams,
+            'solves': len(solves),
+            'iterations': args.iterations,
+            'seed': args.seed,
+            'seed_seconds': round(seed_seconds, 2),
+            'engine_mismatches': engine_mismatches,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if engine_mismatches:
+        print(f'SQL and Python unlock engines disagree on {engine_mismatches} unlocks', file=sys.stderr)
+        sys.exit(1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()